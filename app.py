@@ -1,14 +1,35 @@
 import streamlit as st
-import requests
 import pandas as pd
 import json
 import os
 from dotenv import load_dotenv
-import openai
-import base64
-import time
-from io import BytesIO
-from PIL import Image
+
+from core import (
+    IMAGE_BUDGET,
+    IMAGES_PER_ROOM,
+    MAX_CONCURRENT_ROOMS,
+    MAX_IMAGES_PER_REQUEST,
+    ROOM_TYPES,
+    SELECT_IMAGES,
+    PropertyDetailsError,
+    analisis_manual,
+    analyze_rooms,
+    analyze_rooms_batched,
+    build_analysis,
+    extract_property_id,
+    extract_property_summary,
+    failed_rooms,
+    get_phash_index,
+    get_property_cache,
+    get_property_details,
+    get_thumbnails,
+    get_vision_cache,
+    group_images_by_room,
+    sum_cost_ranges,
+)
+from metrics import get_metrics, start_metrics_server
+from ratelimit import get_rate_limiter
+from results_store import get_results_store
 
 # Configuración de la página
 st.set_page_config(
@@ -24,125 +45,9 @@ st.markdown("Introduce el enlace o ID de un inmueble para analizar sus fotos y o
 # Cargar variables de entorno
 load_dotenv()
 
-# Función para extraer el ID de la propiedad de una URL
-def extract_property_id(url):
-    if not url:
-        return None
-
-    # Si es solo un número, asumimos que es el ID directamente
-    if url.isdigit():
-        return url
-
-    # Intentar extraer el ID de una URL de idealista
-    import re
-    match = re.search(r'/inmueble/(\d+)/', url)
-    if match:
-        return match.group(1)
-
-    return None
-
-# Función para descargar y codificar una imagen en base64
-def get_image_base64(image_url):
-    try:
-        response = requests.get(image_url)
-        if response.status_code == 200:
-            # Redimensionar la imagen para reducir el tamaño
-            img = Image.open(BytesIO(response.content))
-            img = img.resize((800, 600), Image.LANCZOS)
-            buffered = BytesIO()
-            img.save(buffered, format="JPEG", quality=70)
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
-        else:
-            st.error(f"Error al descargar imagen: {response.status_code}")
-            return None
-    except Exception as e:
-        st.error(f"Error procesando imagen: {e}")
-        return None
-
-# Función para analizar una imagen con OpenAI
-def analyze_image_with_openai(image_base64, room_type, api_key):
-    try:
-        # Configurar el cliente de OpenAI directamente en esta función
-        client = openai.OpenAI(api_key=st.secrets["openai"])
-
-        prompt = f"""
-        Analiza esta imagen de un {room_type} en una propiedad inmobiliaria.
-
-        Determina si necesita reforma basándote únicamente en lo que ves en la imagen.
-        Ignora cualquier texto o descripción previa.
-
-        Responde SOLO con un JSON con este formato exacto:
-        {{
-          "necesita_reforma": "si/no/?",
-          "justificación": "breve explicación de por qué necesita o no reforma",
-          "elementos_a_reformar": "lista de elementos que necesitan reforma",
-          "estimación_coste": "rango aproximado en euros"
-        }}
-        """
-
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}",
-                                "detail": "low"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=500
-        )
-
-        analysis_text = response.choices[0].message.content.strip()
-
-        # Limpiar la respuesta si contiene texto adicional
-        if "```json" in analysis_text:
-            analysis_text = analysis_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in analysis_text:
-            analysis_text = analysis_text.split("```")[1].strip()
-
-        return json.loads(analysis_text)
-
-    except Exception as e:
-        st.warning(f"Error al analizar imagen de {room_type}: {e}")
-        # Devolver un análisis por defecto en caso de error
-        return {
-            "necesita_reforma": "?",
-            "justificación": f"No se pudo analizar la imagen: {str(e)}",
-            "elementos_a_reformar": "Desconocido",
-            "estimación_coste": "Desconocido"
-        }
-
-# Función para realizar análisis manual básico
-def analisis_manual(surface_area):
-    # Crear un análisis básico basado en la superficie
-    analisis = {
-        "análisis_por_habitación": {
-            "estancias": {"necesita_reforma": "?", "justificación": "No se pudo analizar las imágenes."},
-            "baños": {"necesita_reforma": "?", "justificación": "No se pudo analizar las imágenes."},
-            "cocina": {"necesita_reforma": "?", "justificación": "No se pudo analizar las imágenes."},
-            "pasillo": {"necesita_reforma": "?", "justificación": "No se pudo analizar las imágenes."}
-        },
-        "estimación_costes": {
-            "total": f"{int(surface_area * 600)} - {int(surface_area * 800)} €",
-            "desglose": {
-                "estancias": f"{int(surface_area * 0.5 * 600)} - {int(surface_area * 0.5 * 800)} €",
-                "baños": f"{int(surface_area * 0.2 * 800)} - {int(surface_area * 0.2 * 1000)} €",
-                "cocina": f"{int(surface_area * 0.2 * 700)} - {int(surface_area * 0.2 * 900)} €",
-                "pasillo": f"{int(surface_area * 0.1 * 500)} - {int(surface_area * 0.1 * 700)} €"
-            }
-        },
-        "nivel_confianza": "bajo",
-        "comentarios_adicionales": "Este análisis es aproximado ya que no se pudieron analizar las imágenes."
-    }
-    return analisis
+# Exponer las métricas en formato Prometheus si se ha configurado un puerto
+if os.getenv("METRICS_PORT"):
+    start_metrics_server(int(os.getenv("METRICS_PORT")))
 
 # Interfaz de usuario para las API keys
 st.sidebar.header("Configuración de API")
@@ -173,10 +78,109 @@ with st.sidebar.expander("Configurar API Keys", expanded=not openai_key):
     api_key = st.text_input("OpenAI API Key", type="password", value=openai_key)
     rapidapi_key = st.text_input("RapidAPI Key", type="password", value=rapidapi_key)
 
+# Permitir ajustar cuántas habitaciones se analizan a la vez
+with st.sidebar.expander("Rendimiento"):
+    max_concurrent_rooms = st.slider(
+        "Habitaciones analizadas en paralelo",
+        min_value=1,
+        max_value=8,
+        value=MAX_CONCURRENT_ROOMS,
+        help="Con 1 se analizan de forma secuencial. El ritmo de llamadas a OpenAI se ajusta solo a los límites de la cuenta."
+    )
+
+    # Agrupar varias fotos y habitaciones en cada petición a OpenAI
+    batched_analysis = st.checkbox(
+        "Agrupar imágenes en una sola petición",
+        help="Envía varias fotos de cada habitación en la misma llamada, reduciendo el número de peticiones."
+    )
+    images_per_room = st.slider("Fotos por habitación", min_value=1, max_value=6, value=IMAGES_PER_ROOM,
+                                disabled=not batched_analysis)
+    max_images_per_request = st.slider("Imágenes por petición", min_value=1, max_value=20, value=MAX_IMAGES_PER_REQUEST,
+                                       disabled=not batched_analysis)
+
+    # Elegir en local las fotos más informativas de cada habitación
+    select_images = st.checkbox(
+        "Elegir las mejores fotos de cada habitación",
+        value=SELECT_IMAGES,
+        help="Puntúa las fotos por nitidez, exposición y variedad de color, descarta las casi duplicadas "
+             "y analiza las mejores en lugar de las primeras. No aumenta el número de llamadas a OpenAI."
+    )
+    image_budget = st.number_input(
+        "Máximo de imágenes por inmueble (0 = sin límite)",
+        min_value=0,
+        max_value=50,
+        value=IMAGE_BUDGET,
+        help="Se reparten primero entre cocina, baños, estancias y pasillo."
+    )
+
+    # Estadísticas de la caché de análisis de imágenes
+    cache_stats = get_vision_cache().stats()
+    st.caption(
+        f"Caché de análisis: {cache_stats['entradas']} entradas, "
+        f"{cache_stats['aciertos']} aciertos, {cache_stats['fallos']} fallos"
+    )
+    if st.button("Vaciar caché de análisis"):
+        get_vision_cache().clear()
+
+    # Estado del control de ritmo de llamadas a OpenAI
+    rate_stats = get_rate_limiter().stats()
+    st.caption(
+        f"OpenAI: {rate_stats['peticiones_por_minuto']:.0f} peticiones/min, "
+        f"{rate_stats['tokens_por_minuto']:.0f} tokens/min, concurrencia {rate_stats['concurrencia']}, "
+        f"{rate_stats['errores_429']} errores 429"
+    )
+
+    # Estadísticas del índice de fotos casi duplicadas
+    phash_stats = get_phash_index().stats()
+    st.caption(
+        f"Fotos casi duplicadas: {phash_stats['imágenes']} indexadas, "
+        f"{phash_stats['llamadas_evitadas']} llamadas a OpenAI evitadas"
+    )
+
+    # Llamadas compartidas entre sesiones que pedían lo mismo a la vez
+    counters = get_metrics().counters()
+    st.caption(
+        f"Llamadas compartidas entre sesiones: {counters.get('coalescidas_detalles_inmueble', 0):.0f} de datos, "
+        f"{counters.get('coalescidas_descarga_imagen', 0):.0f} descargas, "
+        f"{counters.get('coalescidas_analisis', 0):.0f} análisis"
+    )
+
+    # Estadísticas de la caché de datos de inmuebles
+    property_cache_stats = get_property_cache().stats()
+    st.caption(
+        f"Caché de inmuebles: {property_cache_stats['entradas']} entradas, "
+        f"{property_cache_stats['aciertos'] + property_cache_stats['aciertos_caducados']} aciertos, "
+        f"{property_cache_stats['fallos']} fallos"
+    )
+
 # Entrada para la URL o ID del inmueble
 property_url = st.text_input("Introduce la URL o ID del inmueble de Idealista:", placeholder="https://www.idealista.com/inmueble/107442883/ o simplemente 107442883")
 
+# Permitir ignorar la caché y volver a consultar la API de Idealista
+force_refresh = st.checkbox("Actualizar datos del inmueble (ignorar caché)")
+
+# Resultados de cada inmueble guardados en la sesión, para no volver a
+# descargarlos ni analizarlos cada vez que se toca un widget
+if "property_results" not in st.session_state:
+    st.session_state.property_results = {}
+
+# Pestañas del análisis por habitación: clave en el análisis final y en room_analyses
+ROOM_TABS = {
+    "Estancias": ("estancias", "estancia"),
+    "Baños": ("baños", "baño"),
+    "Cocina": ("cocina", "cocina"),
+    "Pasillo": ("pasillo", "pasillo")
+}
+
+# Función para mostrar el análisis de una habitación
+def render_room_analysis(necesita_reforma, justificacion, elementos_a_reformar, estimacion_coste):
+    st.write(f"**Necesita reforma:** {necesita_reforma}")
+    st.write(f"**Justificación:** {justificacion}")
+    st.write(f"**Elementos a reformar:** {elementos_a_reformar}")
+    st.write(f"**Estimación de coste:** {estimacion_coste}")
+
 # Botón para iniciar el análisis
+property_id = None
 if st.button("Analizar inmueble"):
     if not property_url:
         st.error("Por favor, introduce una URL o ID de inmueble válido.")
@@ -189,288 +193,280 @@ if st.button("Analizar inmueble"):
         if not property_id:
             st.error("No se pudo extraer el ID del inmueble. Asegúrate de que la URL es correcta.")
         else:
-            # Mostrar un mensaje de carga
-            with st.spinner(f"Obteniendo datos del inmueble {property_id}..."):
-                # Configurar la solicitud a la API de Idealista
-                url = "https://idealista7.p.rapidapi.com/propertydetails"
-                querystring = {"propertyId": property_id, "location":"es", "language":"es"}
-                headers = {
-                    "x-rapidapi-key": rapidapi_key,
-                    "x-rapidapi-host": "idealista7.p.rapidapi.com"
-                }
-
-                try:
-                    response = requests.get(url, headers=headers, params=querystring)
-                    if response.status_code != 200:
-                        st.error(f"Error al obtener datos del inmueble: {response.status_code}")
-                        st.json(response.text)
-                    else:
-                        property_data = response.json()
-
-                        # Extraer información básica con manejo de errores
-                        try:
-                            surface_area = property_data.get("moreCharacteristics", {}).get("constructedArea", 0)
-                            rooms = property_data.get("moreCharacteristics", {}).get("roomNumber", 0)
-                            bathrooms = property_data.get("moreCharacteristics", {}).get("bathNumber", 0)
-                            price = property_data.get("price", "No disponible")
-
-                            # Intentar obtener la dirección de diferentes maneras
-                            address = "No disponible"
-                            if "address" in property_data:
-                                address = property_data["address"]
-                            elif "location" in property_data:
-                                address = property_data["location"]
-
-                            # Intentar obtener la descripción
-                            description = property_data.get("description", "No disponible")
-
-                        except Exception as e:
-                            st.warning(f"No se pudieron extraer algunos datos básicos: {e}")
-                            # Valores por defecto
-                            surface_area = property_data.get("moreCharacteristics", {}).get("constructedArea", 80)
-                            rooms = property_data.get("moreCharacteristics", {}).get("roomNumber", 0)
-                            bathrooms = property_data.get("moreCharacteristics", {}).get("bathNumber", 0)
-                            price = "No disponible"
-                            address = "No disponible"
-                            description = "No disponible"
-
-                        # Mostrar información básica del inmueble
-                        st.header("Información del inmueble")
-                        col1, col2, col3 = st.columns(3)
-                        with col1:
-                            st.metric("Superficie", f"{surface_area} m²")
-                        with col2:
-                            st.metric("Habitaciones", rooms)
-                        with col3:
-                            st.metric("Baños", bathrooms)
-
-                        if address != "No disponible":
-                            st.subheader("Dirección")
-                            st.write(address)
-
-                        if description != "No disponible":
-                            st.subheader("Descripción")
-                            st.write(description)
-
-                        # Extraer URLs de las imágenes por tipo de habitación
-                        images_by_room = {
-                            "Estancia": [],
-                            "Baño": [],
-                            "Pasillo": [],
-                            "Vistas": [],
-                            "Cocina": [],
-                            "Desconocido": []
-                        }
-
-                        try:
-                            if "multimedia" in property_data and "images" in property_data["multimedia"]:
-                                for img in property_data["multimedia"]["images"]:
-                                    room_type = img.get("localizedName", "Desconocido")
-                                    if room_type in images_by_room:
-                                        images_by_room[room_type].append(img.get("url", ""))
-                                    else:
-                                        images_by_room["Desconocido"].append(img.get("url", ""))
-                            else:
-                                st.warning("No se encontraron imágenes en los datos del inmueble.")
-                        except Exception as e:
-                            st.warning(f"Error al procesar las imágenes: {e}")
-
-                        # Mostrar las imágenes por tipo de habitación
-                        st.header("Imágenes del inmueble")
-
-                        # Crear pestañas para cada tipo de habitación
-                        tabs = st.tabs(list(images_by_room.keys()))
-
-                        for i, (room_type, urls) in enumerate(images_by_room.items()):
-                            with tabs[i]:
-                                if not urls:
-                                    st.write(f"No hay imágenes disponibles de {room_type}")
-                                else:
-                                    # Mostrar las imágenes en una cuadrícula
-                                    cols = st.columns(min(3, len(urls)))
-                                    for j, url in enumerate(urls):
-                                        if url:  # Verificar que la URL no esté vacía
-                                            with cols[j % 3]:
-                                                st.image(url, caption=f"{room_type} {j+1}", use_column_width=True)
-
-                        # Analizar las imágenes con OpenAI
-                        st.header("Análisis de reforma")
-
-                        with st.spinner("Analizando imágenes con IA..."):
-                            try:
-                                # Diccionario para almacenar los resultados por tipo de habitación
-                                room_analyses = {}
-
-                                # Para cada tipo de habitación, analizar una muestra de imágenes
-                                progress_bar = st.progress(0)
-                                total_rooms = len([room for room, urls in images_by_room.items() if urls])
-                                current_room = 0
-
-                                for room_type, urls in images_by_room.items():
-                                    if not urls:  # Si no hay imágenes para este tipo de habitación
-                                        room_analyses[room_type.lower()] = {
-                                            "necesita_reforma": "?",
-                                            "justificación": f"No hay imágenes disponibles de {room_type}.",
-                                            "elementos_a_reformar": "Desconocido",
-                                            "estimación_coste": "Desconocido"
-                                        }
-                                        continue
-
-                                    st.text(f"Analizando {room_type} ({len(urls)} imágenes)...")
-
-                                    # Tomar solo la primera imagen de cada tipo para reducir costes de API
-                                    sample_url = urls[0]
-                                    image_base64 = get_image_base64(sample_url)
-
-                                    if image_base64:
-                                        # Analizar la imagen - pasamos directamente la API key
-                                        analysis = analyze_image_with_openai(image_base64, room_type, api_key)
-                                        room_analyses[room_type.lower()] = analysis
-
-                                        # Pequeña pausa para evitar límites de tasa de la API
-                                        time.sleep(1)
-                                    else:
-                                        room_analyses[room_type.lower()] = {
-                                            "necesita_reforma": "?",
-                                            "justificación": f"No se pudo procesar la imagen de {room_type}.",
-                                            "elementos_a_reformar": "Desconocido",
-                                            "estimación_coste": "Desconocido"
-                                        }
-
-                                    current_room += 1
-                                    progress_bar.progress(current_room / total_rooms if total_rooms > 0 else 1.0)
-
-                                # Si no tenemos análisis para cocina, usar un valor por defecto
-                                if "cocina" not in room_analyses:
-                                    room_analyses["cocina"] = {
-                                        "necesita_reforma": "?",
-                                        "justificación": "No hay imágenes disponibles de la cocina.",
-                                        "elementos_a_reformar": "Desconocido",
-                                        "estimación_coste": "Desconocido"
-                                    }
-
-                                # Crear el análisis completo
-                                analysis = {
-                                    "análisis_por_habitación": {
-                                        "estancias": {
-                                            "necesita_reforma": room_analyses.get("estancia", {}).get("necesita_reforma", "?"),
-                                            "justificación": room_analyses.get("estancia", {}).get("justificación", "No analizado")
-                                        },
-                                        "baños": {
-                                            "necesita_reforma": room_analyses.get("baño", {}).get("necesita_reforma", "?"),
-                                            "justificación": room_analyses.get("baño", {}).get("justificación", "No analizado")
-                                        },
-                                        "cocina": {
-                                            "necesita_reforma": room_analyses.get("cocina", {}).get("necesita_reforma", "?"),
-                                            "justificación": room_analyses.get("cocina", {}).get("justificación", "No analizado")
-                                        },
-                                        "pasillo": {
-                                            "necesita_reforma": room_analyses.get("pasillo", {}).get("necesita_reforma", "?"),
-                                            "justificación": room_analyses.get("pasillo", {}).get("justificación", "No analizado")
-                                        }
-                                    },
-                                    "estimación_costes": {
-                                        "total": "Pendiente de cálculo",
-                                        "desglose": {
-                                            "estancias": room_analyses.get("estancia", {}).get("estimación_coste", "No disponible"),
-                                            "baños": room_analyses.get("baño", {}).get("estimación_coste", "No disponible"),
-                                            "cocina": room_analyses.get("cocina", {}).get("estimación_coste", "No disponible"),
-                                            "pasillo": room_analyses.get("pasillo", {}).get("estimación_coste", "No disponible")
-                                        }
-                                    },
-                                    "elementos_a_reformar": {
-                                        "estancias": room_analyses.get("estancia", {}).get("elementos_a_reformar", "No especificado"),
-                                        "baños": room_analyses.get("baño", {}).get("elementos_a_reformar", "No especificado"),
-                                        "cocina": room_analyses.get("cocina", {}).get("elementos_a_reformar", "No especificado"),
-                                        "pasillo": room_analyses.get("pasillo", {}).get("elementos_a_reformar", "No especificado")
-                                    },
-                                    "nivel_confianza": "medio",
-                                    "comentarios_adicionales": "Este análisis se basa únicamente en el análisis visual de las imágenes disponibles."
-                                }
-
-                                # Calcular una estimación total basada en los análisis individuales
-                                total_min = 0
-                                total_max = 0
-
-                                for room, cost in analysis["estimación_costes"]["desglose"].items():
-                                    if cost != "No disponible" and cost != "Desconocido":
-                                        try:
-                                            # Intentar extraer valores numéricos del rango
-                                            if "-" in cost:
-                                                min_val, max_val = cost.split("-")
-                                                min_val = int(''.join(filter(str.isdigit, min_val)))
-                                                max_val = int(''.join(filter(str.isdigit, max_val)))
-                                                total_min += min_val
-                                                total_max += max_val
-                                        except:
-                                            pass
-
-                                # Si no pudimos calcular un total basado en los desgloses, usar una estimación basada en superficie
-                                if total_min == 0 and total_max == 0:
-                                    total_min = int(surface_area * 600)
-                                    total_max = int(surface_area * 800)
-
-                                analysis["estimación_costes"]["total"] = f"{total_min} - {total_max} €"
-
-                                # Mostrar el análisis por habitación
-                                st.subheader("Análisis por habitación")
-
-                                # Crear pestañas para cada tipo de habitación
-                                room_tabs = st.tabs(["Estancias", "Baños", "Cocina", "Pasillo"])
-
-                                with room_tabs[0]:
-                                    st.write("**Necesita reforma:** " + analysis["análisis_por_habitación"]["estancias"]["necesita_reforma"])
-                                    st.write("**Justificación:** " + analysis["análisis_por_habitación"]["estancias"]["justificación"])
-                                    st.write("**Elementos a reformar:** " + analysis["elementos_a_reformar"]["estancias"])
-                                    st.write("**Estimación de coste:** " + analysis["estimación_costes"]["desglose"]["estancias"])
-
-                                with room_tabs[1]:
-                                    st.write("**Necesita reforma:** " + analysis["análisis_por_habitación"]["baños"]["necesita_reforma"])
-                                    st.write("**Justificación:** " + analysis["análisis_por_habitación"]["baños"]["justificación"])
-                                    st.write("**Elementos a reformar:** " + analysis["elementos_a_reformar"]["baños"])
-                                    st.write("**Estimación de coste:** " + analysis["estimación_costes"]["desglose"]["baños"])
-
-                                with room_tabs[2]:
-                                    st.write("**Necesita reforma:** " + analysis["análisis_por_habitación"]["cocina"]["necesita_reforma"])
-                                    st.write("**Justificación:** " + analysis["análisis_por_habitación"]["cocina"]["justificación"])
-                                    st.write("**Elementos a reformar:** " + analysis["elementos_a_reformar"]["cocina"])
-                                    st.write("**Estimación de coste:** " + analysis["estimación_costes"]["desglose"]["cocina"])
-
-                                with room_tabs[3]:
-                                    st.write("**Necesita reforma:** " + analysis["análisis_por_habitación"]["pasillo"]["necesita_reforma"])
-                                    st.write("**Justificación:** " + analysis["análisis_por_habitación"]["pasillo"]["justificación"])
-                                    st.write("**Elementos a reformar:** " + analysis["elementos_a_reformar"]["pasillo"])
-                                    st.write("**Estimación de coste:** " + analysis["estimación_costes"]["desglose"]["pasillo"])
-
-                                # Mostrar la estimación total
-                                st.subheader("Estimación total de costes")
-                                st.metric("Coste estimado de reforma", analysis["estimación_costes"]["total"])
-
-                                # Nivel de confianza y comentarios adicionales
-                                st.subheader("Información adicional")
-                                st.write("**Nivel de confianza:** " + analysis["nivel_confianza"])
-                                st.write("**Comentarios adicionales:** " + analysis["comentarios_adicionales"])
-
-                                # Opción para descargar el análisis como JSON
-                                st.download_button(
-                                    label="Descargar análisis como JSON",
-                                    data=json.dumps(analysis, ensure_ascii=False, indent=4),
-                                    file_name=f"analisis_inmueble_{property_id}.json",
-                                    mime="application/json"
-                                )
-
-                            except Exception as e:
-                                st.error(f"Error al analizar las imágenes: {e}")
-
-                                # Usar análisis manual si hay un error general
-                                analysis = analisis_manual(surface_area)
-
-                                st.warning("No se pudieron analizar las imágenes. Se ha generado un análisis básico basado en la superficie.")
-                                st.write(f"Superficie: {surface_area} m², lo que podría suponer un coste de reforma entre 600-800€/m².")
-                                st.write(f"Estimación aproximada: {int(surface_area * 700)}€ (±20%)")
-
-                except Exception as e:
-                    st.error(f"Error al procesar el inmueble: {e}")
+            st.session_state.current_property_id = property_id
+
+            # Descartar el resultado guardado si se pide actualizar o si el análisis
+            # falló, entero o en alguna habitación
+            previous_result = st.session_state.property_results.get(property_id)
+            if force_refresh or (
+                previous_result and (previous_result.get("analysis_error") or previous_result.get("failed_rooms"))
+            ):
+                st.session_state.property_results.pop(property_id, None)
+else:
+    # Volver a mostrar el último inmueble de la sesión sin recalcular nada
+    property_id = st.session_state.get("current_property_id")
+
+if property_id:
+    result = st.session_state.property_results.get(property_id)
+
+    if result is None:
+        # Mostrar un mensaje de carga
+        with st.spinner(f"Obteniendo datos del inmueble {property_id}..."):
+            try:
+                property_data = get_property_details(property_id, rapidapi_key, force_refresh=force_refresh)
+                result = {"property_data": property_data, "analysis": None, "analysis_error": None}
+                st.session_state.property_results[property_id] = result
+            except PropertyDetailsError as e:
+                st.error(f"Error al obtener datos del inmueble: {e.status_code}")
+                st.json(e.text)
+            except Exception as e:
+                st.error(f"Error al procesar el inmueble: {e}")
+
+    if result is not None:
+        try:
+            property_data = result["property_data"]
+
+            # Extraer información básica con manejo de errores
+            summary = extract_property_summary(property_data)
+            surface_area = summary["surface_area"]
+            rooms = summary["rooms"]
+            bathrooms = summary["bathrooms"]
+            price = summary["price"]
+            address = summary["address"]
+            description = summary["description"]
+
+            # Mostrar información básica del inmueble
+            st.header("Información del inmueble")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Superficie", f"{surface_area} m²")
+            with col2:
+                st.metric("Habitaciones", rooms)
+            with col3:
+                st.metric("Baños", bathrooms)
+
+            if address != "No disponible":
+                st.subheader("Dirección")
+                st.write(address)
+
+            if description != "No disponible":
+                st.subheader("Descripción")
+                st.write(description)
+
+            # Extraer URLs de las imágenes por tipo de habitación
+            try:
+                images_by_room = group_images_by_room(property_data)
+                if not any(images_by_room.values()):
+                    st.warning("No se encontraron imágenes en los datos del inmueble.")
+            except Exception as e:
+                st.warning(f"Error al procesar las imágenes: {e}")
+                images_by_room = {room_type: [] for room_type in ROOM_TYPES}
+
+            # Mostrar las imágenes por tipo de habitación
+            st.header("Imágenes del inmueble")
+
+            # Elegir un tipo de habitación: solo se cargan las miniaturas del seleccionado
+            room_labels = {f"{room_type} ({len(urls)})": room_type for room_type, urls in images_by_room.items()}
+            selected_room = room_labels[st.radio(
+                "Tipo de habitación",
+                list(room_labels.keys()),
+                horizontal=True,
+                key=f"gallery_room_{property_id}",
+                label_visibility="collapsed"
+            )]
+            urls = [url for url in images_by_room[selected_room] if url]  # Descartar URLs vacías
+
+            if not urls:
+                st.write(f"No hay imágenes disponibles de {selected_room}")
+            else:
+                # Mostrar miniaturas en una cuadrícula, con enlace a la imagen original
+                thumbnails = get_thumbnails(urls, max_workers=max_concurrent_rooms)
+                cols = st.columns(min(3, len(urls)))
+                for j, (url, thumbnail) in enumerate(zip(urls, thumbnails)):
+                    with cols[j % 3]:
+                        if thumbnail is not None:
+                            st.image(thumbnail, caption=f"{selected_room} {j+1}", use_column_width=True)
+                        else:
+                            st.write(f"No se pudo cargar la imagen {selected_room} {j+1}")
+                        st.markdown(f"[Ver a tamaño completo]({url})")
+
+            # Analizar las imágenes con OpenAI
+            st.header("Análisis de reforma")
+
+            # Crear de antemano las pestañas y el total para ir rellenándolos
+            # a medida que llegan los resultados de cada habitación
+            analysis_placeholder = st.empty()
+            with analysis_placeholder.container():
+                st.subheader("Análisis por habitación")
+                room_tabs = st.tabs(list(ROOM_TABS.keys()))
+                room_placeholders = {}
+                for tab, (analysis_key, room_key) in zip(room_tabs, ROOM_TABS.values()):
+                    with tab:
+                        room_placeholders[room_key] = st.empty()
+
+                st.subheader("Estimación total de costes")
+                total_placeholder = st.empty()
+
+            if result["analysis"] is None and result["analysis_error"] is None:
+                for room_key, placeholder in room_placeholders.items():
+                    placeholder.info("Analizando...")
+
+                with st.spinner("Analizando imágenes con IA..."):
+                    try:
+                        # Para cada tipo de habitación, analizar una muestra de imágenes
+                        progress_bar = st.progress(0)
+                        total_rooms = len([room for room, urls in images_by_room.items() if urls])
+                        analyzed_rooms = {}
+
+                        def on_room_done(room_type, room_analysis):
+                            room_key = room_type.lower()
+                            analyzed_rooms[room_key] = room_analysis
+                            progress_bar.progress(len(analyzed_rooms) / total_rooms if total_rooms > 0 else 1.0)
+
+                            # Mostrar la habitación en cuanto llega su resultado
+                            if room_key in room_placeholders:
+                                with room_placeholders[room_key].container():
+                                    render_room_analysis(
+                                        room_analysis.get("necesita_reforma", "?"),
+                                        room_analysis.get("justificación", "No analizado"),
+                                        room_analysis.get("elementos_a_reformar", "No especificado"),
+                                        room_analysis.get("estimación_coste", "No disponible")
+                                    )
+
+                            # Total acumulado con las habitaciones analizadas hasta ahora
+                            partial_min, partial_max = sum_cost_ranges(
+                                analyzed_room.get("estimación_coste", "No disponible")
+                                for key, analyzed_room in analyzed_rooms.items()
+                                if key in room_placeholders
+                            )
+                            total_placeholder.metric(
+                                "Coste estimado de reforma (parcial)",
+                                f"{partial_min} - {partial_max} €",
+                                help=f"{len(analyzed_rooms)} de {total_rooms} tipos de habitación analizados"
+                            )
+
+                        # Diccionario con los resultados por tipo de habitación
+                        if batched_analysis:
+                            room_analyses = analyze_rooms_batched(
+                                images_by_room,
+                                api_key,
+                                max_workers=max_concurrent_rooms,
+                                on_room_done=on_room_done,
+                                images_per_room=images_per_room,
+                                max_images_per_request=max_images_per_request,
+                                select_images=select_images,
+                                image_budget=image_budget
+                            )
+                        else:
+                            room_analyses = analyze_rooms(
+                                images_by_room,
+                                api_key,
+                                max_workers=max_concurrent_rooms,
+                                on_room_done=on_room_done,
+                                select_images=select_images,
+                                image_budget=image_budget
+                            )
+
+                        # Crear el análisis completo y la estimación total de costes
+                        result["analysis"] = build_analysis(room_analyses, surface_area)
+                        result["failed_rooms"] = failed_rooms(room_analyses)
+                        progress_bar.empty()
+
+                    except Exception as e:
+                        result["analysis_error"] = str(e)
+
+                # Guardar el análisis en el almacén de resultados para la vista de
+                # cartera; si alguna habitación falló no se guarda, para que el lote
+                # no lo dé por analizado
+                if result.get("failed_rooms"):
+                    st.warning(
+                        f"No se pudieron analizar: {', '.join(result['failed_rooms'])}. "
+                        "Vuelve a analizar el inmueble para reintentarlo."
+                    )
+                elif result["analysis"] is not None:
+                    try:
+                        get_results_store().add({
+                            "property_id": property_id,
+                            "surface_area": surface_area,
+                            "rooms": rooms,
+                            "bathrooms": bathrooms,
+                            "price": price,
+                            "address": address,
+                            "analysis": result["analysis"]
+                        })
+                    except Exception as e:
+                        st.warning(f"No se pudo guardar el análisis en el histórico: {e}")
+
+            if result["analysis_error"] is not None:
+                analysis_placeholder.empty()
+                st.error(f"Error al analizar las imágenes: {result['analysis_error']}")
+
+                # Usar análisis manual si hay un error general
+                analysis = analisis_manual(surface_area)
+
+                st.warning("No se pudieron analizar las imágenes. Se ha generado un análisis básico basado en la superficie.")
+                st.write(f"Superficie: {surface_area} m², lo que podría suponer un coste de reforma entre 600-800€/m².")
+                st.write(f"Estimación aproximada: {int(surface_area * 700)}€ (±20%)")
+            else:
+                analysis = result["analysis"]
+
+                # Mostrar el análisis final por habitación
+                for analysis_key, room_key in ROOM_TABS.values():
+                    with room_placeholders[room_key].container():
+                        render_room_analysis(
+                            analysis["análisis_por_habitación"][analysis_key]["necesita_reforma"],
+                            analysis["análisis_por_habitación"][analysis_key]["justificación"],
+                            analysis["elementos_a_reformar"][analysis_key],
+                            analysis["estimación_costes"]["desglose"][analysis_key]
+                        )
+
+                # Mostrar la estimación total
+                total_placeholder.metric("Coste estimado de reforma", analysis["estimación_costes"]["total"])
+
+                # Nivel de confianza y comentarios adicionales
+                st.subheader("Información adicional")
+                st.write("**Nivel de confianza:** " + analysis["nivel_confianza"])
+                st.write("**Comentarios adicionales:** " + analysis["comentarios_adicionales"])
+
+                # Opción para descargar el análisis como JSON
+                st.download_button(
+                    label="Descargar análisis como JSON",
+                    data=json.dumps(analysis, ensure_ascii=False, indent=4),
+                    file_name=f"analisis_inmueble_{property_id}.json",
+                    mime="application/json"
+                )
+
+        except Exception as e:
+            st.error(f"Error al procesar el inmueble: {e}")
+
+# Desglose de tiempos por etapa, tokens y coste de este proceso
+with st.sidebar.expander("Métricas"):
+    metrics = get_metrics()
+    stage_rows = metrics.summary()
+    if not stage_rows:
+        st.caption("Todavía no hay métricas.")
+    else:
+        stages = pd.DataFrame(stage_rows).set_index("etapa")
+        durations = ~stages.index.str.endswith("_bytes")
+        stages.loc[durations, ["media", "p50", "p95", "max"]] *= 1000
+        st.caption("Tiempos en milisegundos (tamaños en bytes)")
+        st.dataframe(stages.round(1), use_container_width=True)
+
+    counters = metrics.counters()
+    if counters:
+        st.caption(
+            f"Tokens OpenAI: {counters.get('openai_prompt_tokens', 0):.0f} de entrada, "
+            f"{counters.get('openai_completion_tokens', 0):.0f} de salida "
+            f"(~{counters.get('openai_coste_usd', 0):.4f} $)"
+        )
+        st.json(counters, expanded=False)
+
+    st.download_button(
+        label="Descargar traza (JSON)",
+        data=json.dumps(metrics.to_trace(), ensure_ascii=False),
+        file_name="traza_analisis.json",
+        mime="application/json"
+    )
 
 # Información adicional en el sidebar
 st.sidebar.header("Acerca de")
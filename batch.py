@@ -0,0 +1,275 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from dotenv import load_dotenv
+
+import preprocess
+from metrics import get_metrics, start_metrics_server
+from search import SearchError, iter_search_property_ids
+from core import (
+    IMAGE_BUDGET,
+    IMAGES_PER_ROOM,
+    MAX_CONCURRENT_ROOMS,
+    MAX_IMAGES_PER_REQUEST,
+    SELECT_IMAGES,
+    analyze_property,
+    extract_property_id,
+)
+
+logger = logging.getLogger(__name__)
+
+# Número de inmuebles que se analizan a la vez por defecto
+MAX_CONCURRENT_PROPERTIES = 4
+
+
+# Función para leer IDs de inmuebles (o URLs de Idealista) línea a línea,
+# descartando líneas vacías, comentarios y duplicados
+def read_property_ids(lines):
+    seen = set()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        property_id = extract_property_id(line)
+        if not property_id:
+            logger.warning("No se pudo extraer el ID del inmueble de: %s", line)
+            continue
+
+        if property_id not in seen:
+            seen.add(property_id)
+            yield property_id
+
+
+# Función para cargar los IDs ya procesados de un fichero de checkpoint
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+# Función para analizar una lista de inmuebles con concurrencia acotada,
+# escribiendo cada resultado en JSONL en cuanto termina. Los inmuebles
+# completados se anotan en el checkpoint para poder reanudar la ejecución.
+# Los que fallan se escriben con su error y se reintentan al reanudar. Si se
+# pasa un almacén de resultados, cada análisis correcto se guarda también en él.
+# analyze permite cambiar cómo se analiza cada inmueble (misma firma que
+# analyze_property), por ejemplo para la revisión incremental de watchlist.py.
+def run_batch(property_ids, output, rapidapi_key, api_key, checkpoint_path=None,
+              concurrency=MAX_CONCURRENT_PROPERTIES, room_concurrency=MAX_CONCURRENT_ROOMS,
+              images_per_room=IMAGES_PER_ROOM, max_images_per_request=0, results_store=None,
+              analyze=analyze_property, select_images=SELECT_IMAGES, image_budget=IMAGE_BUDGET):
+    done = load_checkpoint(checkpoint_path)
+    checkpoint = open(checkpoint_path, "a", encoding="utf-8") if checkpoint_path else None
+    stats = {"procesados": 0, "errores": 0, "omitidos": 0}
+
+    def write_result(property_id, result):
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+        if results_store is not None and "error" not in result:
+            results_store.add(result)
+        if checkpoint and "error" not in result:
+            checkpoint.write(property_id + "\n")
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+
+    def process(property_id):
+        started_at = time.time()
+        try:
+            result = analyze(
+                property_id,
+                rapidapi_key,
+                api_key,
+                max_workers=room_concurrency,
+                batched=max_images_per_request > 0,
+                images_per_room=images_per_room,
+                max_images_per_request=max_images_per_request,
+                select_images=select_images,
+                image_budget=image_budget
+            )
+        except Exception as e:
+            result = {"property_id": property_id, "error": str(e)}
+        result["analyzed_at"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(started_at))
+        result["duration_seconds"] = round(time.time() - started_at, 3)
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = {}
+            try:
+                for property_id in property_ids:
+                    if property_id in done:
+                        stats["omitidos"] += 1
+                        continue
+
+                    # No encolar más trabajo del que los hilos pueden procesar
+                    while len(pending) >= concurrency * 2:
+                        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            _record(pending.pop(future), future.result(), write_result, stats)
+
+                    pending[executor.submit(process, property_id)] = property_id
+            finally:
+                # Aunque falle la lectura de IDs (por ejemplo una página de la
+                # búsqueda), los análisis ya lanzados se escriben y se anotan
+                while pending:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        _record(pending.pop(future), future.result(), write_result, stats)
+    finally:
+        if checkpoint:
+            checkpoint.close()
+
+    return stats
+
+
+def _record(property_id, result, write_result, stats):
+    write_result(property_id, result)
+    if "error" in result:
+        stats["errores"] += 1
+        logger.error("Error al analizar el inmueble %s: %s", property_id, result["error"])
+    else:
+        stats["procesados"] += 1
+        logger.info("Inmueble %s analizado en %.1f s", property_id, result["duration_seconds"])
+
+
+def main(argv=None):
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Analiza en lote una lista de inmuebles de Idealista o todos los de una zona."
+    )
+    parser.add_argument("input", nargs="?", default="-",
+                        help="Fichero con un ID o URL de inmueble por línea ('-' para leer de stdin)")
+    search_group = parser.add_argument_group("búsqueda por zona (en lugar de leer IDs)")
+    search_group.add_argument("--location-id",
+                              help="ID de ubicación de Idealista, por ejemplo 0-EU-ES-28-07-001-079")
+    search_group.add_argument("--location-name", help="Nombre de la ubicación")
+    search_group.add_argument("--operation", choices=["sale", "rent"], default="sale")
+    search_group.add_argument("--min-price", type=int)
+    search_group.add_argument("--max-price", type=int)
+    search_group.add_argument("--max-pages", type=int, help="Número máximo de páginas de resultados")
+    search_group.add_argument("--reanalyze", action="store_true",
+                              help="Analizar también los inmuebles que ya están en el almacén de resultados")
+    parser.add_argument("-o", "--output", default="-",
+                        help="Fichero JSONL donde se añaden los resultados ('-' para stdout)")
+    parser.add_argument("--checkpoint",
+                        help="Fichero de checkpoint (por defecto <output>.done si la salida es un fichero)")
+    parser.add_argument("-c", "--concurrency", type=int, default=MAX_CONCURRENT_PROPERTIES,
+                        help="Inmuebles analizados en paralelo")
+    parser.add_argument("--room-concurrency", type=int, default=MAX_CONCURRENT_ROOMS,
+                        help="Habitaciones analizadas en paralelo por inmueble")
+    parser.add_argument("--max-images-per-request", type=int, default=0,
+                        help=f"Agrupa hasta N imágenes por petición a OpenAI (0 = una petición por habitación; "
+                             f"por ejemplo {MAX_IMAGES_PER_REQUEST})")
+    parser.add_argument("--images-per-room", type=int, default=IMAGES_PER_ROOM,
+                        help="Fotos analizadas por habitación en el modo agrupado")
+    parser.add_argument("--image-budget", type=int, default=IMAGE_BUDGET,
+                        help="Máximo de imágenes enviadas a OpenAI por inmueble (0 = sin límite)")
+    parser.add_argument("--no-image-selection", dest="select_images", action="store_false", default=SELECT_IMAGES,
+                        help="Analizar las primeras fotos de cada habitación en vez de elegir las mejores")
+    parser.add_argument("--preprocess-processes", type=int, default=os.cpu_count() or 1,
+                        help="Procesos dedicados a redimensionar imágenes (1 para hacerlo en los hilos)")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("METRICS_PORT", "0")),
+                        help="Puerto donde servir /metrics (Prometheus) y /trace.json durante el lote")
+    parser.add_argument("--trace-file",
+                        help="Fichero JSON donde guardar la traza de tiempos por etapa al terminar")
+    parser.add_argument("--results-store",
+                        help="Carpeta Parquet donde se acumulan los resultados para la vista de cartera "
+                             "(por defecto RESULTS_STORE_PATH o .cache/results; '' para no guardarlos)")
+    parser.add_argument("--openai-key", default=os.getenv("OPENAI_API_KEY", ""))
+    parser.add_argument("--rapidapi-key", default=os.getenv("RAPIDAPI_KEY", ""))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", stream=sys.stderr)
+
+    if not args.openai_key or not args.rapidapi_key:
+        parser.error("Se necesitan las claves de OpenAI y RapidAPI (OPENAI_API_KEY y RAPIDAPI_KEY)")
+
+    preprocess.configure_pool(args.preprocess_processes)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    # pandas y pyarrow solo se cargan si se guardan los resultados
+    results_store = None
+    if args.results_store != "":
+        from results_store import DEFAULT_STORE_PATH, ResultsStore
+        results_store = ResultsStore(args.results_store or DEFAULT_STORE_PATH)
+
+    checkpoint_path = args.checkpoint
+    if checkpoint_path is None and args.output != "-":
+        checkpoint_path = args.output + ".done"
+
+    # Los IDs de la búsqueda llegan en flujo: run_batch solo pide el siguiente
+    # cuando hay hueco en la cola de trabajo, así que las páginas pendientes no
+    # crecen con el número de resultados. Los IDs ya guardados (para omitirlos)
+    # sí se cargan enteros: un texto corto por inmueble del almacén.
+    source = None
+    if args.location_id:
+        property_ids = iter_search_property_ids(
+            args.rapidapi_key,
+            args.location_id,
+            skip=results_store.property_ids() if results_store is not None and not args.reanalyze else (),
+            max_pages=args.max_pages,
+            operation=args.operation,
+            location_name=args.location_name,
+            min_price=args.min_price,
+            max_price=args.max_price
+        )
+    else:
+        source = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+        property_ids = read_property_ids(source)
+
+    output = sys.stdout if args.output == "-" else open(args.output, "a", encoding="utf-8")
+    try:
+        stats = run_batch(
+            property_ids,
+            output,
+            args.rapidapi_key,
+            args.openai_key,
+            checkpoint_path=checkpoint_path,
+            concurrency=args.concurrency,
+            room_concurrency=args.room_concurrency,
+            images_per_room=args.images_per_room,
+            max_images_per_request=args.max_images_per_request,
+            results_store=results_store,
+            select_images=args.select_images,
+            image_budget=args.image_budget
+        )
+    except SearchError as e:
+        logger.error("%s; lote interrumpido (los inmuebles ya analizados están guardados): %s", e, e.text[:200])
+        return 1
+    finally:
+        if source is not None and source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+
+    logger.info(
+        "Lote terminado: %d analizados, %d con error, %d omitidos por checkpoint",
+        stats["procesados"], stats["errores"], stats["omitidos"]
+    )
+    if args.location_id:
+        logger.info(
+            "Búsqueda: %d resultados, %d omitidos por estar ya analizados",
+            get_metrics().counters().get("busqueda_resultados", 0),
+            get_metrics().counters().get("busqueda_omitidos", 0)
+        )
+    for row in get_metrics().summary():
+        logger.info(
+            "Etapa %s: n=%d p50=%.3f p95=%.3f max=%.3f",
+            row["etapa"], row["n"], row["p50"], row["p95"], row["max"]
+        )
+    if args.trace_file:
+        get_metrics().export_trace(args.trace_file)
+    return 1 if stats["errores"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,359 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from metrics import _percentile, get_metrics
+
+# Tipos de habitación que devuelve el falso propertydetails, en este orden
+FAKE_ROOM_NAMES = ["Estancia", "Cocina", "Baño", "Pasillo", "Vistas", "Dormitorio", "Fachada", "Terraza"]
+
+# Respuesta que devuelve el falso OpenAI para cada habitación
+FAKE_ROOM_ANALYSIS = {
+    "necesita_reforma": "si",
+    "justificación": "Acabados antiguos y desgaste visible.",
+    "elementos_a_reformar": "suelo, carpintería, pintura",
+    "estimación_coste": "3.000 - 6.000 €"
+}
+
+
+# Función para generar una foto JPEG sintética y determinista para cada nombre,
+# con textura suficiente para que cada imagen sea distinta de las demás
+def make_fake_jpeg(name, width, height, quality=85):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(zlib.crc32(name.encode("utf-8")))
+    small = (rng.random((max(2, height // 100), max(2, width // 100), 3)) * 255).astype("uint8")
+    img = Image.fromarray(small).resize((width, height), Image.BICUBIC)
+
+    buffered = io.BytesIO()
+    img.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+# Servidor que imita propertydetails y listhomes de RapidAPI, el CDN de imágenes de
+# Idealista y el endpoint chat/completions de OpenAI
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = {}
+    images = OrderedDict()
+    images_lock = threading.Lock()
+    openai_requests = deque()
+    openai_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == "/propertydetails":
+            self._property_details(parse_qs(parsed.query).get("propertyId", ["0"])[0])
+        elif parsed.path == "/listhomes":
+            query = parse_qs(parsed.query)
+            self._list_homes(int(query.get("numPage", ["1"])[0]), int(query.get("maxItems", ["40"])[0]))
+        elif parsed.path.startswith("/images/"):
+            self._image(parsed.path[len("/images/"):])
+        else:
+            self._send_json(404, {"message": "Not found"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/chat/completions"):
+            self._chat_completion(json.loads(body))
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def _property_details(self, property_id):
+        config = self.config
+        time.sleep(config["details_latency"])
+
+        base_url = f"http://{self.headers['Host']}"
+        images = [
+            {
+                "localizedName": FAKE_ROOM_NAMES[k % len(FAKE_ROOM_NAMES)],
+                "url": f"{base_url}/images/{property_id}-{k}.jpg"
+            }
+            for k in range(config["images_per_listing"])
+        ]
+        self._send_json(200, {
+            "propertyCode": property_id,
+            "price": 150000 + int(property_id) % 100 * 1000,
+            "moreCharacteristics": {"constructedArea": 60 + int(property_id) % 60, "roomNumber": 3, "bathNumber": 1},
+            "multimedia": {"images": images}
+        })
+
+    def _list_homes(self, page, page_size):
+        config = self.config
+        time.sleep(config["details_latency"])
+
+        total = config["listings"]
+        first = (page - 1) * page_size
+        self._send_json(200, {
+            "elementList": [
+                {"propertyCode": str(100000 + i), "price": 150000 + i % 100 * 1000}
+                for i in range(first, min(total, first + page_size))
+            ],
+            "total": total,
+            "totalPages": max(1, -(-total // page_size)),
+            "actualPage": page,
+            "itemsPerPage": page_size
+        })
+
+    def _image(self, name):
+        config = self.config
+        time.sleep(config["image_latency"])
+
+        with self.images_lock:
+            data = self.images.get(name)
+        if data is None:
+            data = make_fake_jpeg(name, config["image_width"], config["image_height"])
+            with self.images_lock:
+                self.images[name] = data
+                while len(self.images) > 512:
+                    self.images.popitem(last=False)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _chat_completion(self, payload):
+        config = self.config
+        now = time.monotonic()
+        with self.openai_lock:
+            while self.openai_requests and now - self.openai_requests[0] > 60:
+                self.openai_requests.popleft()
+            self.openai_requests.append(now)
+            used_requests = len(self.openai_requests)
+
+        headers = {
+            "x-ratelimit-limit-requests": str(config["rpm"]),
+            "x-ratelimit-limit-tokens": str(config["tpm"]),
+            "x-ratelimit-remaining-requests": str(max(0, config["rpm"] - used_requests)),
+            "x-ratelimit-remaining-tokens": str(config["tpm"]),
+            "x-ratelimit-reset-requests": "1s",
+            "x-ratelimit-reset-tokens": "1s"
+        }
+
+        if random.random() < config["rate_429"] or used_requests > config["rpm"]:
+            headers["retry-after"] = "0.2"
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, headers)
+            return
+
+        time.sleep(max(0.0, random.gauss(config["openai_latency"], config["openai_jitter"])))
+
+        content = payload["messages"][0]["content"]
+        rooms = [
+            match.group(1)
+            for part in content if part.get("type") == "text"
+            for match in [re.match(r"Imagen \d+: (.*)", part["text"])] if match
+        ]
+        images = sum(1 for part in content if part.get("type") == "image_url")
+        if rooms:
+            answer = {"imágenes": [], "habitaciones": {room: FAKE_ROOM_ANALYSIS for room in dict.fromkeys(rooms)}}
+        else:
+            answer = FAKE_ROOM_ANALYSIS
+
+        prompt_tokens = 150 + 85 * images
+        completion_tokens = 80 * max(1, len(set(rooms)))
+        self._send_json(200, {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "```json\n" + json.dumps(answer, ensure_ascii=False) + "\n```"},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }, headers)
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _serve_fake_upstream(config, port_queue):
+    FakeUpstreamHandler.config = config
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeUpstreamHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+# Función para arrancar los servidores falsos en otro proceso, de modo que su
+# CPU y su memoria no se mezclen con las del pipeline que se mide
+def start_fake_upstream(config):
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve_fake_upstream, args=(config, port_queue), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=30)
+
+
+# Función para ejecutar el pipeline de batch.py contra los servidores falsos
+# y medir rendimiento, latencias, CPU y memoria
+def run_benchmark(args):
+    config = {
+        "details_latency": args.details_latency,
+        "image_latency": args.image_latency,
+        "image_width": args.image_width,
+        "image_height": args.image_height,
+        "images_per_listing": args.images_per_listing,
+        "openai_latency": args.openai_latency,
+        "openai_jitter": args.openai_jitter,
+        "rate_429": args.rate_429,
+        "rpm": args.rpm,
+        "tpm": args.tpm,
+        "listings": args.listings
+    }
+    server_process, port = start_fake_upstream(config)
+    base_url = f"http://127.0.0.1:{port}"
+
+    # La configuración se lee al importar los módulos, así que se fija antes
+    cache_dir = tempfile.mkdtemp(prefix="benchmark_cache_") if not args.warm else ".cache"
+    os.environ["IDEALISTA_API_URL"] = base_url
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ["VISION_CACHE_PATH"] = os.path.join(cache_dir, "vision_cache.sqlite3")
+    os.environ["PROPERTY_CACHE_PATH"] = os.path.join(cache_dir, "property_cache.sqlite3")
+    os.environ["PHASH_INDEX_PATH"] = os.path.join(cache_dir, "phash_index.sqlite3")
+
+    import preprocess
+    from batch import run_batch
+
+    preprocess.configure_pool(args.preprocess_processes)
+
+    if args.search:
+        from search import iter_search_property_ids
+        property_ids = iter_search_property_ids("benchmark", "0-EU-ES-28")
+    else:
+        property_ids = [str(100000 + i) for i in range(args.listings)]
+    output = io.StringIO()
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started_at = time.perf_counter()
+    try:
+        stats = run_batch(
+            property_ids,
+            output,
+            "benchmark",
+            "benchmark",
+            concurrency=args.concurrency,
+            room_concurrency=args.room_concurrency,
+            images_per_room=args.images_per_room,
+            max_images_per_request=args.max_images_per_request
+        )
+    finally:
+        elapsed = time.perf_counter() - started_at
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+        # Los procesos del pool solo cuentan en RUSAGE_CHILDREN una vez
+        # terminados; el servidor falso se para después para no sumarlo
+        preprocess.configure_pool(0, wait=True)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        server_process.terminate()
+
+    latencies = sorted(
+        json.loads(line)["duration_seconds"] for line in output.getvalue().splitlines() if line
+    )
+    cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    children_cpu_seconds = (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime)
+    summary = get_metrics().summary()
+
+    return {
+        "inmuebles": args.listings,
+        "analizados": stats["procesados"],
+        "errores": stats["errores"],
+        "segundos": round(elapsed, 3),
+        "inmuebles_por_segundo": round(args.listings / elapsed, 3) if elapsed else 0.0,
+        "latencia_p50": round(_percentile(latencies, 0.50), 3),
+        "latencia_p95": round(_percentile(latencies, 0.95), 3),
+        "latencia_p99": round(_percentile(latencies, 0.99), 3),
+        "latencia_max": round(latencies[-1], 3) if latencies else 0.0,
+        "cpu_segundos": round(cpu_seconds, 3),
+        "cpu_segundos_subprocesos": round(children_cpu_seconds, 3),
+        "memoria_pico_mb": round(usage_after.ru_maxrss / 1024, 1),
+        "memoria_pico_subprocesos_mb": round(children_after.ru_maxrss / 1024, 1),
+        "llamadas_openai": next((row["n"] for row in summary if row["etapa"] == "openai"), 0),
+        "contadores": get_metrics().counters(),
+        "etapas": summary
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Mide el rendimiento del pipeline sin gastar cuota, contra servidores locales "
+                    "que imitan RapidAPI, el CDN de imágenes y OpenAI."
+    )
+    parser.add_argument("-n", "--listings", type=int, default=50, help="Número de inmuebles a analizar")
+    parser.add_argument("--images-per-listing", type=int, default=8)
+    parser.add_argument("--image-width", type=int, default=1600)
+    parser.add_argument("--image-height", type=int, default=1200)
+    parser.add_argument("--details-latency", type=float, default=0.15, help="Latencia de propertydetails (s)")
+    parser.add_argument("--image-latency", type=float, default=0.05, help="Latencia del CDN de imágenes (s)")
+    parser.add_argument("--openai-latency", type=float, default=1.0, help="Latencia media de OpenAI (s)")
+    parser.add_argument("--openai-jitter", type=float, default=0.3, help="Desviación de la latencia de OpenAI (s)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fracción de peticiones a OpenAI que devuelven 429")
+    parser.add_argument("--rpm", type=int, default=5000, help="Límite de peticiones por minuto que anuncia el falso OpenAI")
+    parser.add_argument("--tpm", type=int, default=2000000, help="Límite de tokens por minuto que anuncia el falso OpenAI")
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("--room-concurrency", type=int, default=4)
+    parser.add_argument("--images-per-room", type=int, default=2)
+    parser.add_argument("--max-images-per-request", type=int, default=0)
+    parser.add_argument("--preprocess-processes", type=int, default=1)
+    parser.add_argument("--search", action="store_true",
+                        help="Obtener los IDs paginando la búsqueda por zona en lugar de pasarlos en una lista")
+    parser.add_argument("--warm", action="store_true", help="Usar las cachés locales en lugar de unas vacías")
+    parser.add_argument("--json", help="Fichero donde guardar el informe en JSON")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args)
+
+    print(f"Inmuebles: {report['analizados']}/{report['inmuebles']} ({report['errores']} con error)")
+    print(f"Tiempo total: {report['segundos']} s, {report['inmuebles_por_segundo']} inmuebles/s")
+    print(
+        f"Latencia por inmueble: p50 {report['latencia_p50']} s, p95 {report['latencia_p95']} s, "
+        f"p99 {report['latencia_p99']} s, máx {report['latencia_max']} s"
+    )
+    print(f"CPU: {report['cpu_segundos']} s (+{report['cpu_segundos_subprocesos']} s en subprocesos)")
+    print(f"Memoria pico: {report['memoria_pico_mb']} MB")
+    if args.preprocess_processes > 1:
+        # Las páginas compartidas con el proceso principal cuentan en ambos
+        print(f"Memoria pico del mayor proceso de preprocesado: {report['memoria_pico_subprocesos_mb']} MB")
+    print(f"Llamadas a OpenAI: {report['llamadas_openai']}")
+    for row in report["etapas"]:
+        print(f"  {row['etapa']:<24} n={row['n']:<6} p50={row['p50']:.4f} p95={row['p95']:.4f} max={row['max']:.4f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    return 1 if report["errores"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,823 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from metrics import get_metrics
+from phash_index import PerceptualIndex, compute_phash
+from preprocess import IMAGE_DETAIL, encode_base64, preprocess
+from property_cache import PropertyDetailsCache
+from thumbnails import IMAGE_CACHE_MAX_BYTES, THUMBNAIL_CACHE_MAX_BYTES, BytesLRU, make_thumbnail
+from ratelimit import estimate_tokens
+from selection import MAX_CANDIDATES_PER_ROOM, allocate_budget, image_features, rank_images
+from singleflight import SingleFlight
+from transport import create_chat_completion, get_http_transport, get_openai_client
+from vision_cache import VisionCache, make_cache_key
+
+logger = logging.getLogger(__name__)
+
+# Número de habitaciones que se analizan en paralelo por defecto
+MAX_CONCURRENT_ROOMS = 4
+
+# Fotos por habitación e imágenes por petición en el modo agrupado
+IMAGES_PER_ROOM = int(os.getenv("IMAGES_PER_ROOM", "2"))
+MAX_IMAGES_PER_REQUEST = int(os.getenv("MAX_IMAGES_PER_REQUEST", "8"))
+
+# Elegir las fotos analizadas puntuándolas en local en vez de tomar las
+# primeras, y máximo de imágenes enviadas a OpenAI por inmueble (0 = sin límite)
+SELECT_IMAGES = os.getenv("SELECT_IMAGES", "1") == "1"
+IMAGE_BUDGET = int(os.getenv("IMAGE_BUDGET", "0"))
+
+# Tipos de habitación en los que se agrupan las imágenes del inmueble
+ROOM_TYPES = ["Estancia", "Baño", "Pasillo", "Vistas", "Cocina", "Desconocido"]
+
+# URL base de la API de Idealista en RapidAPI (configurable para pruebas)
+IDEALISTA_API_URL = os.getenv("IDEALISTA_API_URL", "https://idealista7.p.rapidapi.com")
+
+# Modelo y prompt usados para analizar las imágenes
+OPENAI_MODEL = "gpt-4o"
+ANALYSIS_PROMPT = """
+        Analiza esta imagen de un {room_type} en una propiedad inmobiliaria.
+
+        Determina si necesita reforma basándote únicamente en lo que ves en la imagen.
+        Ignora cualquier texto o descripción previa.
+
+        Responde SOLO con un JSON con este formato exacto:
+        {{
+          "necesita_reforma": "si/no/?",
+          "justificación": "breve explicación de por qué necesita o no reforma",
+          "elementos_a_reformar": "lista de elementos que necesitan reforma",
+          "estimación_coste": "rango aproximado en euros"
+        }}
+        """
+
+# Prompt para analizar varias habitaciones en una misma petición
+BATCH_ANALYSIS_PROMPT = """
+        Analiza las siguientes imágenes de una propiedad inmobiliaria. Antes de
+        cada imagen se indica su número y el tipo de habitación al que pertenece.
+
+        Para cada imagen, y después para cada tipo de habitación teniendo en cuenta
+        todas sus imágenes, determina si necesita reforma basándote únicamente en
+        lo que ves. Ignora cualquier texto o descripción previa.
+
+        Responde SOLO con un JSON con este formato exacto:
+        {
+          "imágenes": [
+            {"número": 1, "habitación": "tipo de habitación", "necesita_reforma": "si/no/?", "justificación": "breve explicación"}
+          ],
+          "habitaciones": {
+            "tipo de habitación": {
+              "necesita_reforma": "si/no/?",
+              "justificación": "breve explicación de por qué necesita o no reforma",
+              "elementos_a_reformar": "lista de elementos que necesitan reforma",
+              "estimación_coste": "rango aproximado en euros"
+            }
+          }
+        }
+        """
+
+# Versión del análisis: cambia si cambia el modelo o el prompt, invalidando la caché
+PROMPT_VERSION = hashlib.sha256(f"{OPENAI_MODEL}\0{ANALYSIS_PROMPT}".encode("utf-8")).hexdigest()[:16]
+BATCH_PROMPT_VERSION = hashlib.sha256(f"{OPENAI_MODEL}\0{BATCH_ANALYSIS_PROMPT}".encode("utf-8")).hexdigest()[:16]
+
+_vision_cache = None
+_property_cache = None
+_phash_index = None
+_caches_lock = threading.Lock()
+_image_cache = BytesLRU(IMAGE_CACHE_MAX_BYTES)
+_thumbnail_cache = BytesLRU(THUMBNAIL_CACHE_MAX_BYTES)
+
+# Llamadas en curso compartidas entre sesiones: datos de inmuebles, descargas
+# de imágenes y análisis con OpenAI
+_details_flight = SingleFlight("detalles_inmueble")
+_download_flight = SingleFlight("descarga_imagen")
+_analysis_flight = SingleFlight("analisis")
+
+
+# Error devuelto por la API de Idealista al pedir los datos de un inmueble
+class PropertyDetailsError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(f"Error al obtener datos del inmueble: {status_code}")
+        self.status_code = status_code
+        self.text = text
+
+
+# Función para extraer el ID de la propiedad de una URL
+def extract_property_id(url):
+    if not url:
+        return None
+
+    # Si es solo un número, asumimos que es el ID directamente
+    if url.isdigit():
+        return url
+
+    # Intentar extraer el ID de una URL de idealista
+    match = re.search(r'/inmueble/(\d+)/', url)
+    if match:
+        return match.group(1)
+
+    return None
+
+
+# Caché de análisis compartida por todo el proceso
+def get_vision_cache():
+    global _vision_cache
+    with _caches_lock:
+        if _vision_cache is None:
+            _vision_cache = VisionCache()
+        return _vision_cache
+
+
+# Caché de datos de inmuebles compartida por todo el proceso
+def get_property_cache():
+    global _property_cache
+    with _caches_lock:
+        if _property_cache is None:
+            _property_cache = PropertyDetailsCache()
+        return _property_cache
+
+
+# Índice de imágenes casi duplicadas compartido por todo el proceso
+def get_phash_index():
+    global _phash_index
+    with _caches_lock:
+        if _phash_index is None:
+            _phash_index = PerceptualIndex()
+        return _phash_index
+
+
+# Función para descargar los datos de un inmueble de la API de Idealista
+def fetch_property_details(property_id, rapidapi_key):
+    # Configurar la solicitud a la API de Idealista
+    url = f"{IDEALISTA_API_URL}/propertydetails"
+    querystring = {"propertyId": property_id, "location":"es", "language":"es"}
+    headers = {
+        "x-rapidapi-key": rapidapi_key,
+        "x-rapidapi-host": "idealista7.p.rapidapi.com"
+    }
+
+    with get_metrics().span("detalles_inmueble", property_id=property_id) as span:
+        response = get_http_transport().get(url, headers=headers, params=querystring)
+        span["status"] = response.status_code
+    if response.status_code != 200:
+        raise PropertyDetailsError(response.status_code, response.text)
+    return response.json()
+
+
+# Función para obtener los datos de un inmueble, sirviéndolos desde la caché si es posible.
+# Si otra sesión ya está descargando el mismo inmueble se espera su respuesta.
+def get_property_details(property_id, rapidapi_key, force_refresh=False):
+    get_metrics().increment("consultas_inmueble")
+    return get_property_cache().get(
+        property_id,
+        lambda: _details_flight.do(property_id, fetch_property_details, property_id, rapidapi_key),
+        force_refresh=force_refresh
+    )
+
+
+# Función para extraer la información básica del inmueble con valores por defecto
+def extract_property_summary(property_data):
+    characteristics = property_data.get("moreCharacteristics", {})
+    try:
+        # Intentar obtener la dirección de diferentes maneras
+        address = "No disponible"
+        if "address" in property_data:
+            address = property_data["address"]
+        elif "location" in property_data:
+            address = property_data["location"]
+
+        return {
+            "surface_area": characteristics.get("constructedArea", 0),
+            "rooms": characteristics.get("roomNumber", 0),
+            "bathrooms": characteristics.get("bathNumber", 0),
+            "price": property_data.get("price", "No disponible"),
+            "address": address,
+            "description": property_data.get("description", "No disponible")
+        }
+    except Exception as e:
+        logger.warning("No se pudieron extraer algunos datos básicos: %s", e)
+        return {
+            "surface_area": characteristics.get("constructedArea", 80),
+            "rooms": characteristics.get("roomNumber", 0),
+            "bathrooms": characteristics.get("bathNumber", 0),
+            "price": "No disponible",
+            "address": "No disponible",
+            "description": "No disponible"
+        }
+
+
+# Función para agrupar las URLs de las imágenes por tipo de habitación
+def group_images_by_room(property_data):
+    images_by_room = {room_type: [] for room_type in ROOM_TYPES}
+
+    for img in property_data.get("multimedia", {}).get("images", []):
+        room_type = img.get("localizedName", "Desconocido")
+        if room_type in images_by_room:
+            images_by_room[room_type].append(img.get("url", ""))
+        else:
+            images_by_room["Desconocido"].append(img.get("url", ""))
+
+    return images_by_room
+
+
+# Función para descargar una imagen y devolver sus bytes originales. Las
+# descargas se guardan en memoria para que la galería y el análisis no
+# descarguen dos veces la misma foto, y las descargas simultáneas de la
+# misma URL se comparten.
+def download_image(image_url):
+    data = _image_cache.get(image_url)
+    if data is not None:
+        get_metrics().increment("cache_imagenes_aciertos")
+        return data
+
+    return _download_flight.do(image_url, _download_image, image_url)
+
+
+def _download_image(image_url):
+    # Puede que otra llamada la haya descargado justo antes
+    data = _image_cache.get(image_url)
+    if data is not None:
+        return data
+
+    try:
+        with get_metrics().span("descarga_imagen", url=image_url) as span:
+            response = get_http_transport().get(image_url)
+            span["status"] = response.status_code
+            span["bytes"] = len(response.content)
+        if response.status_code == 200:
+            _image_cache.set(image_url, response.content)
+            return response.content
+        logger.error("Error al descargar imagen: %s", response.status_code)
+        return None
+    except Exception as e:
+        logger.error("Error al descargar imagen: %s", e)
+        return None
+
+
+# Función para obtener la miniatura de una imagen para la galería
+def get_thumbnail(image_url):
+    thumbnail = _thumbnail_cache.get(image_url)
+    if thumbnail is not None:
+        return thumbnail
+
+    data = download_image(image_url)
+    if data is None:
+        return None
+
+    try:
+        thumbnail = make_thumbnail(data)
+    except Exception as e:
+        logger.error("Error generando miniatura: %s", e)
+        return None
+
+    _thumbnail_cache.set(image_url, thumbnail)
+    return thumbnail
+
+
+# Función para obtener en paralelo las miniaturas de varias imágenes
+def get_thumbnails(image_urls, max_workers=MAX_CONCURRENT_ROOMS):
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return list(executor.map(get_thumbnail, image_urls))
+
+
+# Función para descargar, preprocesar y codificar una imagen en base64
+def get_image_base64(image_url, detail=IMAGE_DETAIL):
+    data = download_image(image_url)
+    if data is None:
+        return None
+
+    try:
+        return preprocess_for_openai(data, detail)
+    except Exception as e:
+        logger.error("Error procesando imagen: %s", e)
+        return None
+
+
+# Función para reducir la imagen a la resolución que usa el modelo para este
+# nivel de detalle y codificarla en base64, midiendo tiempo y tamaño
+def preprocess_for_openai(data, detail=IMAGE_DETAIL):
+    with get_metrics().span("preprocesado", bytes_originales=len(data)) as span:
+        image_base64 = encode_base64(preprocess(data, detail))
+        span["bytes_base64"] = len(image_base64)
+    get_metrics().observe("tamano_base64_bytes", len(image_base64))
+    return image_base64
+
+
+# Función para puntuar una foto (nitidez, exposición, color y pHash)
+def score_image(image_url):
+    data = download_image(image_url)
+    if data is None:
+        return None
+
+    try:
+        with get_metrics().span("puntuacion_imagen"):
+            return image_features(data)
+    except Exception as e:
+        logger.warning("No se pudo puntuar la imagen %s: %s", image_url, e)
+        return None
+
+
+# Función para elegir qué fotos de cada habitación se analizan: hasta per_room
+# por habitación y como mucho budget en total. Con rank se puntúan en local y
+# se eligen las más nítidas, mejor expuestas y variadas; si no, las primeras.
+def select_room_images(images_by_room, per_room, budget=None, rank=SELECT_IMAGES, max_workers=MAX_CONCURRENT_ROOMS):
+    candidates = {
+        room_type: [url for url in urls if url][:MAX_CANDIDATES_PER_ROOM if rank else per_room]
+        for room_type, urls in images_by_room.items()
+    }
+
+    # Solo hace falta puntuar las habitaciones con más fotos de las que se eligen
+    to_score = list(dict.fromkeys(
+        url for urls in candidates.values() if len(urls) > per_room for url in urls
+    ))
+    if rank and to_score:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            features = dict(zip(to_score, executor.map(score_image, to_score)))
+        for room_type, urls in candidates.items():
+            if len(urls) > per_room:
+                candidates[room_type] = rank_images([(url, features[url]) for url in urls])
+
+    return allocate_budget(candidates, per_room, budget)
+
+
+# Función para construir el bloque de contenido de una imagen para OpenAI
+def image_content(image_base64, detail=IMAGE_DETAIL):
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:image/jpeg;base64,{image_base64}",
+            "detail": detail
+        }
+    }
+
+
+# Función para extraer el JSON de la respuesta del modelo
+def parse_json_response(analysis_text):
+    analysis_text = analysis_text.strip()
+
+    # Limpiar la respuesta si contiene texto adicional
+    if "```json" in analysis_text:
+        analysis_text = analysis_text.split("```json")[1].split("```")[0].strip()
+    elif "```" in analysis_text:
+        analysis_text = analysis_text.split("```")[1].strip()
+
+    return json.loads(analysis_text)
+
+
+# Función para analizar una imagen con OpenAI. Los análisis simultáneos de la
+# misma imagen (por ejemplo, desde varias sesiones) comparten una sola llamada.
+def analyze_image_with_openai(image_base64, room_type, api_key, detail=IMAGE_DETAIL):
+    cache_key = make_cache_key(image_base64, room_type, f"{PROMPT_VERSION}:{detail}")
+    return _analysis_flight.do(cache_key, _analyze_image_with_openai, image_base64, room_type, api_key, detail, cache_key)
+
+
+def _analyze_image_with_openai(image_base64, room_type, api_key, detail, cache_key):
+    # Consultar la caché antes de llamar a OpenAI
+    vision_cache = get_vision_cache()
+    cached_analysis = vision_cache.get(cache_key)
+    if cached_analysis is not None:
+        get_metrics().increment("cache_analisis_aciertos")
+        return cached_analysis
+    get_metrics().increment("cache_analisis_fallos")
+
+    try:
+        # Reutilizar el cliente de OpenAI compartido para esta API key
+        client = get_openai_client(api_key)
+
+        prompt = ANALYSIS_PROMPT.format(room_type=room_type)
+
+        response = create_chat_completion(
+            client,
+            estimate_tokens(len(prompt), images=1, detail=detail, max_tokens=500),
+            model=OPENAI_MODEL,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        image_content(image_base64, detail)
+                    ]
+                }
+            ],
+            max_tokens=500
+        )
+
+        analysis = parse_json_response(response.choices[0].message.content)
+        vision_cache.set(cache_key, analysis)
+        return analysis
+
+    except Exception as e:
+        logger.warning("Error al analizar imagen de %s: %s", room_type, e)
+        # Devolver un análisis por defecto en caso de error
+        return room_without_analysis(f"No se pudo analizar la imagen: {str(e)}")
+
+
+# Función para realizar análisis manual básico
+def analisis_manual(surface_area):
+    # Crear un análisis básico basado en la superficie
+    analisis = {
+        "análisis_por_habitación": {
+            "estancias": {"necesita_reforma": "?", "justificación": "No se pudo analizar las imágenes."},
+            "baños": {"necesita_reforma": "?", "justificación": "No se pudo analizar las imágenes."},
+            "cocina": {"necesita_reforma": "?", "justificación": "No se pudo analizar las imágenes."},
+            "pasillo": {"necesita_reforma": "?", "justificación": "No se pudo analizar las imágenes."}
+        },
+        "estimación_costes": {
+            "total": f"{int(surface_area * 600)} - {int(surface_area * 800)} €",
+            "desglose": {
+                "estancias": f"{int(surface_area * 0.5 * 600)} - {int(surface_area * 0.5 * 800)} €",
+                "baños": f"{int(surface_area * 0.2 * 800)} - {int(surface_area * 0.2 * 1000)} €",
+                "cocina": f"{int(surface_area * 0.2 * 700)} - {int(surface_area * 0.2 * 900)} €",
+                "pasillo": f"{int(surface_area * 0.1 * 500)} - {int(surface_area * 0.1 * 700)} €"
+            }
+        },
+        "nivel_confianza": "bajo",
+        "comentarios_adicionales": "Este análisis es aproximado ya que no se pudieron analizar las imágenes."
+    }
+    return analisis
+
+
+# Función para construir el análisis por defecto de una habitación sin resultado.
+# fallido indica que la habitación tenía fotos y el análisis no llegó a hacerse
+# (error de descarga, de OpenAI...), a diferencia de las que se omiten a propósito.
+def room_without_analysis(justificacion, fallido=True):
+    return {
+        "necesita_reforma": "?",
+        "justificación": justificacion,
+        "elementos_a_reformar": "Desconocido",
+        "estimación_coste": "Desconocido",
+        "análisis_fallido": fallido
+    }
+
+
+# Función para obtener las habitaciones cuyo análisis falló
+def failed_rooms(room_analyses):
+    return [room_type for room_type, analysis in room_analyses.items() if analysis.get("análisis_fallido")]
+
+
+# Función para analizar una habitación: descarga, preprocesado y análisis con IA
+def analyze_room(room_type, urls, api_key):
+    # Analizar solo la primera foto (la mejor elegida) para reducir costes de API
+    sample_url = urls[0]
+    data = download_image(sample_url)
+    if data is None:
+        return room_without_analysis(f"No se pudo procesar la imagen de {room_type}.")
+
+    # Reutilizar el análisis de una foto casi idéntica si ya se analizó antes
+    phash_index = get_phash_index()
+    analysis_version = f"{PROMPT_VERSION}:{IMAGE_DETAIL}"
+    image_hash = None
+    try:
+        image_hash = compute_phash(data)
+        reused_analysis = phash_index.lookup(image_hash, room_type, analysis_version)
+        if reused_analysis is not None:
+            get_metrics().increment("phash_reutilizados")
+            return reused_analysis
+    except Exception as e:
+        logger.warning("No se pudo calcular el hash perceptual de la imagen de %s: %s", room_type, e)
+
+    try:
+        image_base64 = preprocess_for_openai(data)
+    except Exception as e:
+        logger.error("Error procesando imagen: %s", e)
+        return room_without_analysis(f"No se pudo procesar la imagen de {room_type}.")
+
+    # Analizar la imagen - pasamos directamente la API key
+    analysis = analyze_image_with_openai(image_base64, room_type, api_key)
+
+    # Los análisis fallidos o no concluyentes no se reutilizan
+    if image_hash is not None and analysis.get("necesita_reforma") != "?":
+        phash_index.add(image_hash, room_type, analysis_version, analysis)
+    return analysis
+
+
+# Función para marcar las habitaciones con fotos que se quedaron fuera del
+# presupuesto de imágenes
+def rooms_over_budget(images_by_room, selected, on_room_done=None):
+    results = {}
+    for room_type, urls in images_by_room.items():
+        if any(urls) and not selected.get(room_type):
+            results[room_type] = room_without_analysis(
+                f"{room_type} no se analizó por el límite de imágenes por inmueble.", fallido=False
+            )
+            if on_room_done:
+                on_room_done(room_type, results[room_type])
+    return results
+
+
+# Función para analizar todas las habitaciones, en paralelo si max_workers > 1
+def analyze_rooms(images_by_room, api_key, max_workers=MAX_CONCURRENT_ROOMS, on_room_done=None,
+                  select_images=SELECT_IMAGES, image_budget=IMAGE_BUDGET):
+    # Una foto por habitación: la mejor puntuada o la primera
+    selected = select_room_images(images_by_room, 1, image_budget, rank=select_images, max_workers=max_workers)
+    rooms_to_analyze = [(room_type, urls) for room_type, urls in selected.items() if urls]
+    results = rooms_over_budget(images_by_room, selected, on_room_done)
+
+    if max_workers <= 1:
+        # Modo secuencial: una habitación detrás de otra
+        for room_type, urls in rooms_to_analyze:
+            results[room_type] = analyze_room(room_type, urls, api_key)
+            if on_room_done:
+                on_room_done(room_type, results[room_type])
+    else:
+        # Modo concurrente: cada hilo descarga, preprocesa y analiza una habitación,
+        # de modo que las etapas de distintas habitaciones se solapan
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(analyze_room, room_type, urls, api_key): room_type
+                for room_type, urls in rooms_to_analyze
+            }
+            for future in as_completed(futures):
+                room_type = futures[future]
+                results[room_type] = future.result()
+                if on_room_done:
+                    on_room_done(room_type, results[room_type])
+
+    return ordered_room_analyses(images_by_room, results)
+
+
+# Función para construir el diccionario de análisis en el orden original de las habitaciones
+def ordered_room_analyses(images_by_room, results):
+    room_analyses = {}
+    for room_type, urls in images_by_room.items():
+        if room_type in results:
+            room_analyses[room_type.lower()] = results[room_type]
+        else:
+            room_analyses[room_type.lower()] = room_without_analysis(
+                f"No hay imágenes disponibles de {room_type}.", fallido=False
+            )
+
+    return room_analyses
+
+
+# Función para repartir las habitaciones en peticiones de como mucho
+# max_images imágenes, sin partir nunca las fotos de una misma habitación
+def pack_room_requests(room_images, max_images):
+    requests_to_send = []
+    current = []
+    current_size = 0
+
+    for room_type, images in room_images:
+        images = images[:max_images]
+        if current and current_size + len(images) > max_images:
+            requests_to_send.append(current)
+            current = []
+            current_size = 0
+        current.append((room_type, images))
+        current_size += len(images)
+
+    if current:
+        requests_to_send.append(current)
+    return requests_to_send
+
+
+# Función para analizar varias habitaciones (y varias fotos de cada una) en
+# una sola petición a OpenAI. Devuelve un análisis por habitación. Las
+# peticiones simultáneas con las mismas habitaciones e imágenes se comparten.
+def analyze_rooms_with_openai(room_images, api_key, detail=IMAGE_DETAIL):
+    cache_version = f"{BATCH_PROMPT_VERSION}:{detail}"
+    keyed_rooms = [
+        (room_type, images, make_cache_key("\0".join(images), room_type, cache_version))
+        for room_type, images in room_images
+    ]
+    flight_key = ":".join(cache_key for _, _, cache_key in keyed_rooms)
+    return _analysis_flight.do(flight_key, _analyze_rooms_with_openai, keyed_rooms, api_key, detail)
+
+
+def _analyze_rooms_with_openai(keyed_rooms, api_key, detail):
+    # Consultar la caché por habitación antes de llamar a OpenAI
+    vision_cache = get_vision_cache()
+    results = {}
+    pending = []
+    for room_type, images, cache_key in keyed_rooms:
+        cached_analysis = vision_cache.get(cache_key)
+        if cached_analysis is not None:
+            get_metrics().increment("cache_analisis_aciertos")
+            results[room_type] = cached_analysis
+        else:
+            get_metrics().increment("cache_analisis_fallos")
+            pending.append((room_type, images, cache_key))
+
+    if not pending:
+        return results
+
+    # Numerar las imágenes e indicar a qué habitación pertenece cada una
+    content = [{"type": "text", "text": BATCH_ANALYSIS_PROMPT}]
+    index = 0
+    for room_type, images, cache_key in pending:
+        for image_base64 in images:
+            index += 1
+            content.append({"type": "text", "text": f"Imagen {index}: {room_type}"})
+            content.append(image_content(image_base64, detail))
+
+    try:
+        client = get_openai_client(api_key)
+        max_tokens = 300 + 150 * index
+        prompt_chars = sum(len(part["text"]) for part in content if part["type"] == "text")
+        response = create_chat_completion(
+            client,
+            estimate_tokens(prompt_chars, images=index, detail=detail, max_tokens=max_tokens),
+            model=OPENAI_MODEL,
+            messages=[{"role": "user", "content": content}],
+            max_tokens=max_tokens
+        )
+
+        room_results = parse_json_response(response.choices[0].message.content).get("habitaciones", {})
+        room_results = {name.lower(): analysis for name, analysis in room_results.items()}
+
+        for room_type, images, cache_key in pending:
+            analysis = room_results.get(room_type.lower())
+            if analysis is None:
+                results[room_type] = room_without_analysis(f"No se recibió análisis para {room_type}.")
+            else:
+                vision_cache.set(cache_key, analysis)
+                results[room_type] = analysis
+
+    except Exception as e:
+        logger.warning("Error al analizar imágenes de %s: %s", ", ".join(room for room, _, _ in pending), e)
+        for room_type, images, cache_key in pending:
+            results[room_type] = room_without_analysis(f"No se pudo analizar la imagen: {str(e)}")
+
+    return results
+
+
+# Función para analizar todas las habitaciones agrupando varias imágenes por
+# petición: hasta images_per_room fotos de cada habitación y como mucho
+# max_images_per_request imágenes en cada llamada a OpenAI
+def analyze_rooms_batched(images_by_room, api_key, max_workers=MAX_CONCURRENT_ROOMS, on_room_done=None,
+                          images_per_room=IMAGES_PER_ROOM, max_images_per_request=MAX_IMAGES_PER_REQUEST,
+                          select_images=SELECT_IMAGES, image_budget=IMAGE_BUDGET):
+    selected = select_room_images(images_by_room, images_per_room, image_budget, rank=select_images,
+                                  max_workers=max_workers)
+    sample_urls = [(room_type, url) for room_type, urls in selected.items() for url in urls]
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # Descargar y preprocesar todas las imágenes en paralelo
+        encoded = list(executor.map(lambda item: get_image_base64(item[1]), sample_urls))
+
+        room_images = {}
+        for (room_type, url), image_base64 in zip(sample_urls, encoded):
+            if image_base64:
+                room_images.setdefault(room_type, []).append(image_base64)
+
+        results = rooms_over_budget(images_by_room, selected, on_room_done)
+        for room_type, urls in selected.items():
+            if urls and room_type not in room_images:
+                results[room_type] = room_without_analysis(f"No se pudo procesar la imagen de {room_type}.")
+                if on_room_done:
+                    on_room_done(room_type, results[room_type])
+
+        # Enviar las peticiones agrupadas en paralelo
+        futures = {
+            executor.submit(analyze_rooms_with_openai, request_rooms, api_key): request_rooms
+            for request_rooms in pack_room_requests(list(room_images.items()), max_images_per_request)
+        }
+        for future in as_completed(futures):
+            for room_type, analysis in future.result().items():
+                results[room_type] = analysis
+                if on_room_done:
+                    on_room_done(room_type, analysis)
+
+    return ordered_room_analyses(images_by_room, results)
+
+
+# Función para extraer los valores numéricos de un rango de coste ("1.000 - 2.000 €")
+def parse_cost_range(cost):
+    if cost == "No disponible" or cost == "Desconocido":
+        return None
+    try:
+        if "-" not in cost:
+            return None
+        min_val, max_val = cost.split("-")
+        min_val = int(''.join(filter(str.isdigit, min_val)))
+        max_val = int(''.join(filter(str.isdigit, max_val)))
+        return min_val, max_val
+    except:
+        return None
+
+
+# Función para sumar una lista de rangos de coste, ignorando los que no se entienden
+def sum_cost_ranges(costs):
+    total_min = 0
+    total_max = 0
+    for cost in costs:
+        cost_range = parse_cost_range(cost)
+        if cost_range is not None:
+            total_min += cost_range[0]
+            total_max += cost_range[1]
+    return total_min, total_max
+
+
+# Función para construir el análisis completo a partir de los análisis por habitación
+def build_analysis(room_analyses, surface_area):
+    # Si no tenemos análisis para cocina, usar un valor por defecto
+    if "cocina" not in room_analyses:
+        room_analyses["cocina"] = room_without_analysis("No hay imágenes disponibles de la cocina.", fallido=False)
+
+    # Crear el análisis completo
+    analysis = {
+        "análisis_por_habitación": {
+            "estancias": {
+                "necesita_reforma": room_analyses.get("estancia", {}).get("necesita_reforma", "?"),
+                "justificación": room_analyses.get("estancia", {}).get("justificación", "No analizado")
+            },
+            "baños": {
+                "necesita_reforma": room_analyses.get("baño", {}).get("necesita_reforma", "?"),
+                "justificación": room_analyses.get("baño", {}).get("justificación", "No analizado")
+            },
+            "cocina": {
+                "necesita_reforma": room_analyses.get("cocina", {}).get("necesita_reforma", "?"),
+                "justificación": room_analyses.get("cocina", {}).get("justificación", "No analizado")
+            },
+            "pasillo": {
+                "necesita_reforma": room_analyses.get("pasillo", {}).get("necesita_reforma", "?"),
+                "justificación": room_analyses.get("pasillo", {}).get("justificación", "No analizado")
+            }
+        },
+        "estimación_costes": {
+            "total": "Pendiente de cálculo",
+            "desglose": {
+                "estancias": room_analyses.get("estancia", {}).get("estimación_coste", "No disponible"),
+                "baños": room_analyses.get("baño", {}).get("estimación_coste", "No disponible"),
+                "cocina": room_analyses.get("cocina", {}).get("estimación_coste", "No disponible"),
+                "pasillo": room_analyses.get("pasillo", {}).get("estimación_coste", "No disponible")
+            }
+        },
+        "elementos_a_reformar": {
+            "estancias": room_analyses.get("estancia", {}).get("elementos_a_reformar", "No especificado"),
+            "baños": room_analyses.get("baño", {}).get("elementos_a_reformar", "No especificado"),
+            "cocina": room_analyses.get("cocina", {}).get("elementos_a_reformar", "No especificado"),
+            "pasillo": room_analyses.get("pasillo", {}).get("elementos_a_reformar", "No especificado")
+        },
+        "nivel_confianza": "medio",
+        "comentarios_adicionales": "Este análisis se basa únicamente en el análisis visual de las imágenes disponibles."
+    }
+
+    # Calcular una estimación total basada en los análisis individuales
+    total_min, total_max = sum_cost_ranges(analysis["estimación_costes"]["desglose"].values())
+
+    # Si no pudimos calcular un total basado en los desgloses, usar una estimación basada en superficie
+    if total_min == 0 and total_max == 0:
+        total_min = int(surface_area * 600)
+        total_max = int(surface_area * 800)
+
+    analysis["estimación_costes"]["total"] = f"{total_min} - {total_max} €"
+
+    return analysis
+
+
+# Función para analizar un inmueble completo sin interfaz: datos, imágenes y costes.
+# Si alguna habitación con fotos no se pudo analizar, el resultado lleva "error"
+# (además del análisis parcial) para que no se dé por terminado y se reintente.
+def analyze_property(property_id, rapidapi_key, api_key, max_workers=MAX_CONCURRENT_ROOMS, force_refresh=False,
+                     batched=False, images_per_room=IMAGES_PER_ROOM, max_images_per_request=MAX_IMAGES_PER_REQUEST,
+                     select_images=SELECT_IMAGES, image_budget=IMAGE_BUDGET):
+    property_data = get_property_details(property_id, rapidapi_key, force_refresh=force_refresh)
+    summary = extract_property_summary(property_data)
+    error = None
+
+    try:
+        images_by_room = group_images_by_room(property_data)
+        if batched:
+            room_analyses = analyze_rooms_batched(
+                images_by_room,
+                api_key,
+                max_workers=max_workers,
+                images_per_room=images_per_room,
+                max_images_per_request=max_images_per_request,
+                select_images=select_images,
+                image_budget=image_budget
+            )
+        else:
+            room_analyses = analyze_rooms(
+                images_by_room,
+                api_key,
+                max_workers=max_workers,
+                select_images=select_images,
+                image_budget=image_budget
+            )
+        failed = failed_rooms(room_analyses)
+        if failed:
+            error = f"No se pudieron analizar las imágenes de: {', '.join(failed)}"
+        analysis = build_analysis(room_analyses, summary["surface_area"])
+    except Exception as e:
+        # Usar análisis manual si hay un error general
+        logger.error("Error al analizar las imágenes de %s: %s", property_id, e)
+        error = f"Error al analizar las imágenes: {e}"
+        analysis = analisis_manual(summary["surface_area"])
+
+    result = {
+        "property_id": property_id,
+        "surface_area": summary["surface_area"],
+        "rooms": summary["rooms"],
+        "bathrooms": summary["bathrooms"],
+        "price": summary["price"],
+        "address": summary["address"],
+        "analysis": analysis
+    }
+    if error:
+        result["error"] = error
+    return result
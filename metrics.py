@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Número de muestras que se guardan por etapa para calcular percentiles y
+# número máximo de spans que se conservan para exportar la traza
+MAX_SAMPLES_PER_STAGE = int(os.getenv("METRICS_MAX_SAMPLES", "2000"))
+MAX_TRACE_EVENTS = int(os.getenv("METRICS_MAX_TRACE_EVENTS", "20000"))
+
+# Precio de gpt-4o en dólares por millón de tokens (entrada, salida)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+}
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# Registro de métricas del proceso: duración de cada etapa, distribuciones de
+# valores (por ejemplo tamaño de las imágenes), contadores y una traza de spans
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES_PER_STAGE))
+        self._totals = defaultdict(lambda: [0, 0.0])
+        self._counters = defaultdict(float)
+        self._events = deque(maxlen=MAX_TRACE_EVENTS)
+        self._origin = time.time()
+
+    # Registra un valor de la distribución name (segundos para las etapas)
+    def observe(self, name, value):
+        with self._lock:
+            self._samples[name].append(value)
+            totals = self._totals[name]
+            totals[0] += 1
+            totals[1] += value
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    # Mide la duración del bloque como una etapa y la añade a la traza; los
+    # atributos se pueden completar dentro del bloque a través del dict devuelto
+    @contextmanager
+    def span(self, stage, **attributes):
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = str(e)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.observe(stage, duration)
+            with self._lock:
+                self._events.append({
+                    "name": stage,
+                    "ph": "X",
+                    "ts": int((started_at - self._origin) * 1e6),
+                    "dur": int(duration * 1e6),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": attributes
+                })
+
+    # Registra los tokens de una respuesta de OpenAI y su coste estimado
+    def record_openai_usage(self, model, prompt_tokens, completion_tokens):
+        input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        self.increment("openai_prompt_tokens", prompt_tokens)
+        self.increment("openai_completion_tokens", completion_tokens)
+        self.increment("openai_coste_usd", (prompt_tokens * input_price + completion_tokens * output_price) / 1e6)
+
+    # Resumen por etapa: número de muestras, media, p50, p95 y máximo
+    def summary(self):
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items()}
+            totals = {name: tuple(values) for name, values in self._totals.items()}
+
+        rows = []
+        for name, values in sorted(samples.items()):
+            count, total = totals[name]
+            rows.append({
+                "etapa": name,
+                "n": count,
+                "media": total / count if count else 0.0,
+                "p50": _percentile(values, 0.50),
+                "p95": _percentile(values, 0.95),
+                "max": values[-1] if values else 0.0
+            })
+        return rows
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    # Métricas en formato de texto de Prometheus
+    def to_prometheus(self, prefix="ideal_listo"):
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items()}
+            totals = {name: tuple(values) for name, values in self._totals.items()}
+            counters = dict(self._counters)
+
+        lines = [
+            f"# HELP {prefix}_stage Duración de cada etapa en segundos (o valor observado)",
+            f"# TYPE {prefix}_stage summary"
+        ]
+        for name, values in sorted(samples.items()):
+            for quantile in (0.5, 0.95, 0.99):
+                lines.append(f'{prefix}_stage{{stage="{name}",quantile="{quantile}"}} {_percentile(values, quantile)}')
+            count, total = totals[name]
+            lines.append(f'{prefix}_stage_sum{{stage="{name}"}} {total}')
+            lines.append(f'{prefix}_stage_count{{stage="{name}"}} {count}')
+
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+
+        return "\n".join(lines) + "\n"
+
+    # Traza en formato Chrome Trace Event (se abre en Perfetto o chrome://tracing)
+    def to_trace(self):
+        with self._lock:
+            events = list(self._events)
+            counters = dict(self._counters)
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"counters": counters}}
+
+    def export_trace(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_trace(), f, ensure_ascii=False)
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._totals.clear()
+            self._counters.clear()
+            self._events.clear()
+
+
+_registry = MetricsRegistry()
+_server = None
+_server_lock = threading.Lock()
+
+
+# Función para obtener el registro de métricas compartido por todo el proceso
+def get_metrics():
+    return _registry
+
+
+# Servidor HTTP mínimo con /metrics (Prometheus) y /trace.json
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = _registry.to_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/trace.json":
+            body = json.dumps(_registry.to_trace(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Función para arrancar (una sola vez por proceso) el servidor de métricas
+def start_metrics_server(port, host="0.0.0.0"):
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
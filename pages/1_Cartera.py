@@ -0,0 +1,113 @@
+import time
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from results_store import ROOM_KEYS, get_results_store, portfolio_metrics, portfolio_summary
+
+# Configuración de la página
+st.set_page_config(
+    page_title="Cartera de inmuebles",
+    page_icon="📊",
+    layout="wide"
+)
+
+st.title("Cartera de inmuebles analizados")
+st.markdown("Costes de reforma y precio por m² de todos los inmuebles analizados en la aplicación o con batch.py")
+
+
+# Función para cargar la tabla de resultados con sus métricas; se vuelve a
+# leer solo cuando cambian los ficheros del almacén
+@st.cache_data(show_spinner=False)
+def load_portfolio(version):
+    return portfolio_metrics(get_results_store().load())
+
+
+started_at = time.perf_counter()
+portfolio = load_portfolio(get_results_store().version())
+
+if portfolio.empty:
+    st.info("Todavía no hay inmuebles analizados.")
+    st.stop()
+
+# Filtros sobre la cartera
+with st.sidebar.expander("Filtros", expanded=True):
+    max_price = float(np.nan_to_num(portfolio["price"].max()))
+    price_range = st.slider("Precio (€)", 0.0, max(max_price, 1.0), (0.0, max(max_price, 1.0)), step=1000.0)
+    min_surface = st.number_input("Superficie mínima (m²)", min_value=0, value=0, step=10)
+    only_analyzed = st.checkbox("Excluir estimaciones solo por superficie",
+                                help="Descarta los inmuebles en los que no se pudieron analizar las imágenes")
+
+mask = portfolio["surface_area"].ge(min_surface) & (
+    portfolio["price"].between(*price_range) | portfolio["price"].isna()
+)
+if only_analyzed:
+    mask &= portfolio["confidence"].ne("bajo").fillna(True)
+selected = portfolio[mask]
+
+# Resumen de la cartera
+col1, col2, col3, col4 = st.columns(4)
+with col1:
+    st.metric("Inmuebles", f"{len(selected)} de {len(portfolio)}")
+with col2:
+    st.metric("Coste medio de reforma", f"{selected['cost_mid_total'].mean():,.0f} €")
+with col3:
+    st.metric("Mediana precio/m²", f"{selected['price_per_m2'].median():,.0f} €")
+with col4:
+    st.metric("Mediana precio/m² reformado", f"{selected['adjusted_price_per_m2'].median():,.0f} €")
+
+st.subheader("Distribuciones")
+summary = portfolio_summary(selected).rename(index={
+    "cost_mid_total": "Coste de reforma (€)",
+    "cost_per_m2": "Coste de reforma por m² (€)",
+    "price_per_m2": "Precio por m² (€)",
+    "adjusted_price_per_m2": "Precio por m² con reforma (€)"
+})
+st.dataframe(summary.round(1), use_container_width=True)
+
+col1, col2 = st.columns(2)
+with col1:
+    st.caption("Precio por m² con reforma")
+    values = selected["adjusted_price_per_m2"].dropna().to_numpy()
+    if len(values):
+        counts, edges = np.histogram(values, bins=min(30, max(1, len(values))))
+        st.bar_chart(pd.Series(counts, index=np.round((edges[:-1] + edges[1:]) / 2).astype(int)))
+with col2:
+    st.caption("Inmuebles que necesitan reforma por tipo de habitación")
+    flags = selected[[f"needs_renovation_{room}" for room in ROOM_KEYS]]
+    st.bar_chart(pd.Series(flags.fillna(False).astype(bool).mean().to_numpy(), index=ROOM_KEYS))
+
+# Tabla de inmuebles ordenada por precio por m² con reforma
+st.subheader("Inmuebles")
+st.dataframe(
+    selected.sort_values("adjusted_price_per_m2")[[
+        "property_id", "analyzed_at", "address", "surface_area", "price", "cost_min_total", "cost_max_total",
+        "cost_per_m2", "price_per_m2", "adjusted_price_per_m2", "renovation_share", "rooms_to_renovate", "confidence"
+    ]],
+    use_container_width=True,
+    hide_index=True,
+    column_config={
+        "property_id": st.column_config.TextColumn("ID"),
+        "analyzed_at": st.column_config.DatetimeColumn("Analizado", format="YYYY-MM-DD HH:mm"),
+        "address": st.column_config.TextColumn("Dirección"),
+        "surface_area": st.column_config.NumberColumn("m²", format="%.0f"),
+        "price": st.column_config.NumberColumn("Precio (€)", format="%.0f"),
+        "cost_min_total": st.column_config.NumberColumn("Reforma mín. (€)", format="%.0f"),
+        "cost_max_total": st.column_config.NumberColumn("Reforma máx. (€)", format="%.0f"),
+        "cost_per_m2": st.column_config.NumberColumn("Reforma/m² (€)", format="%.0f"),
+        "price_per_m2": st.column_config.NumberColumn("Precio/m² (€)", format="%.0f"),
+        "adjusted_price_per_m2": st.column_config.NumberColumn("Precio/m² reformado (€)", format="%.0f"),
+        "renovation_share": st.column_config.NumberColumn("Reforma / precio", format="%.2f"),
+        "rooms_to_renovate": st.column_config.NumberColumn("Habitaciones a reformar"),
+        "confidence": st.column_config.TextColumn("Confianza")
+    }
+)
+
+st.download_button(
+    label="Descargar cartera (CSV)",
+    data=selected.to_csv(index=False),
+    file_name="cartera_inmuebles.csv",
+    mime="text/csv"
+)
+st.caption(f"Calculado en {(time.perf_counter() - started_at) * 1000:.0f} ms")
@@ -0,0 +1,252 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from io import BytesIO
+
+from PIL import Image
+
+# Configuración del índice de imágenes casi duplicadas
+DEFAULT_INDEX_PATH = os.getenv("PHASH_INDEX_PATH", os.path.join(".cache", "phash_index.sqlite3"))
+DEFAULT_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "8"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("PHASH_INDEX_MAX_ENTRIES", "20000"))
+DEFAULT_MAX_AGE_DAYS = float(os.getenv("PHASH_INDEX_MAX_AGE_DAYS", "90"))
+
+# Cada cuántas escrituras se comprueba si hay que expulsar entradas
+EVICTION_INTERVAL = 100
+
+# Tamaño de la imagen reducida sobre la que se calcula la DCT y del bloque
+# de bajas frecuencias que forma el hash (8x8 = 64 bits)
+PHASH_IMAGE_SIZE = 32
+PHASH_HASH_SIZE = 8
+
+
+# numpy se importa al calcular el primer hash para no retrasar el arranque
+@lru_cache(maxsize=None)
+def _dct_matrix(n):
+    import numpy as np
+
+    k = np.arange(n).reshape(-1, 1)
+    i = np.arange(n).reshape(1, -1)
+    return np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+
+
+# Función para calcular el hash perceptual (pHash) de 64 bits de una imagen:
+# escala de grises a 32x32, DCT 2D y comparación de las 8x8 frecuencias más
+# bajas con su mediana. Es estable frente a recompresión, cambios de tamaño
+# y recortes ligeros.
+def compute_phash(data):
+    import numpy as np
+
+    img = Image.open(BytesIO(data))
+    img.draft("L", (PHASH_IMAGE_SIZE * 4, PHASH_IMAGE_SIZE * 4))
+    img = img.convert("L").resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.BILINEAR)
+
+    pixels = np.asarray(img, dtype=np.float64)
+    dct_matrix = _dct_matrix(PHASH_IMAGE_SIZE)
+    dct = dct_matrix @ pixels @ dct_matrix.T
+    low = dct[:PHASH_HASH_SIZE, :PHASH_HASH_SIZE].flatten()
+    # El coeficiente DC solo refleja el brillo medio y no se usa para la mediana
+    bits = low > np.median(low[1:])
+
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+# Función para calcular el hash de diferencias (dHash) de 64 bits, más barato
+# que el pHash aunque algo menos robusto
+def compute_dhash(data):
+    import numpy as np
+
+    img = Image.open(BytesIO(data))
+    img.draft("L", (64, 64))
+    img = img.convert("L").resize((PHASH_HASH_SIZE + 1, PHASH_HASH_SIZE), Image.BILINEAR)
+
+    pixels = np.asarray(img, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+# Árbol BK para búsquedas por distancia de Hamming: cada nodo guarda sus
+# hijos por distancia, y la desigualdad triangular permite descartar ramas
+# enteras, de modo que una búsqueda con radio pequeño visita pocos nodos.
+class BKTree:
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, value, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(key, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, value, {}]
+                return
+            node = child
+
+    def search(self, key, max_distance):
+        matches = []
+        if self.root is None:
+            return matches
+
+        candidates = [self.root]
+        while candidates:
+            node = candidates.pop()
+            distance = hamming_distance(key, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    candidates.append(child)
+
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+# Índice persistente de imágenes ya analizadas por hash perceptual. Permite
+# reutilizar el análisis de una foto casi idéntica (misma foto recomprimida,
+# redimensionada o recortada) en lugar de volver a llamar a OpenAI. Solo se
+# reutilizan análisis del mismo tipo de habitación y de la misma versión del
+# prompt/modelo. Las entradas caducan y se expulsan igual que en VisionCache, y
+# cada árbol BK (uno por habitación y versión) se carga la primera vez que se usa.
+class PerceptualIndex:
+    def __init__(self, path=DEFAULT_INDEX_PATH, max_distance=DEFAULT_MAX_DISTANCE, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 3600
+        self.lookups = 0
+        self.reused = 0
+        self._trees = {}
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # Las entradas de versiones anteriores del índice no llevan versión
+            # del análisis y no se pueden reutilizar con seguridad
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(phash_index)")}
+            if columns and "version" not in columns:
+                self._conn.execute("DROP TABLE phash_index")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS phash_index (
+                    phash TEXT NOT NULL,
+                    room_type TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_phash_index_room ON phash_index (room_type, version)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_phash_index_access ON phash_index (last_access)")
+            self._conn.commit()
+        self.evict()
+
+    # Árbol BK de un tipo de habitación y versión, cargado de SQLite al pedirlo
+    def _tree(self, room_type, version):
+        tree = self._trees.get((room_type, version))
+        if tree is None:
+            tree = BKTree()
+            rows = self._conn.execute(
+                "SELECT rowid, phash, result, created_at FROM phash_index WHERE room_type = ? AND version = ?",
+                (room_type, version)
+            )
+            for rowid, phash, result, created_at in rows:
+                tree.add(int(phash, 16), (rowid, created_at, json.loads(result)))
+            self._trees[(room_type, version)] = tree
+        return tree
+
+    # Devuelve el análisis de la imagen más parecida de la misma habitación y
+    # versión dentro del umbral, o None
+    def lookup(self, image_hash, room_type, version, max_distance=None):
+        max_distance = self.max_distance if max_distance is None else max_distance
+        now = time.time()
+        with self._lock:
+            self.lookups += 1
+            matches = [
+                match for match in self._tree(room_type, version).search(image_hash, max_distance)
+                if now - match[1][1] <= self.max_age
+            ]
+            if not matches:
+                return None
+
+            rowid, _, result = matches[0][1]
+            self._conn.execute("UPDATE phash_index SET last_access = ? WHERE rowid = ?", (now, rowid))
+            self._conn.commit()
+            self.reused += 1
+        return result
+
+    def add(self, image_hash, room_type, version, result):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                """
+                INSERT INTO phash_index (phash, room_type, version, result, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (f"{image_hash:016x}", room_type, version, json.dumps(result, ensure_ascii=False), now, now)
+            )
+            self._conn.commit()
+            if (room_type, version) in self._trees:
+                self._trees[(room_type, version)].add(image_hash, (cursor.lastrowid, now, result))
+            self._writes += 1
+            needs_eviction = self._writes % EVICTION_INTERVAL == 0
+
+        if needs_eviction:
+            self.evict()
+
+    # Borra las entradas más antiguas que max_age y, por encima de
+    # max_entries, las menos usadas. Los árboles se vuelven a cargar después.
+    def evict(self):
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM phash_index WHERE created_at < ?", (time.time() - self.max_age,)
+            ).rowcount
+            count = self._conn.execute("SELECT COUNT(*) FROM phash_index").fetchone()[0]
+            if count > self.max_entries:
+                deleted += self._conn.execute(
+                    """
+                    DELETE FROM phash_index WHERE rowid IN (
+                        SELECT rowid FROM phash_index ORDER BY last_access ASC LIMIT ?
+                    )
+                    """,
+                    (count - self.max_entries,)
+                ).rowcount
+            self._conn.commit()
+            if deleted:
+                self._trees = {}
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM phash_index").fetchone()[0]
+            return {
+                "imágenes": entries,
+                "consultas": self.lookups,
+                "llamadas_evitadas": self.reused
+            }
@@ -0,0 +1,92 @@
+import atexit
+import base64
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# Nivel de detalle con el que se envían las imágenes a OpenAI
+IMAGE_DETAIL = os.getenv("OPENAI_IMAGE_DETAIL", "low")
+JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "75"))
+
+# Resolución que consume el modelo en cada nivel de detalle: con "low" ve la
+# imagen reducida a 512x512; con "high" la ajusta a 2048x2048 y después deja
+# el lado corto en 768 px. Enviar más píxeles solo cuesta bytes y latencia.
+LOW_DETAIL_MAX_SIDE = 512
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Función para calcular el tamaño objetivo de una imagen según el nivel de
+# detalle, conservando la relación de aspecto y sin ampliar nunca la imagen
+def target_size(width, height, detail=IMAGE_DETAIL):
+    if detail == "high":
+        scale = min(1.0, HIGH_DETAIL_MAX_SIDE / max(width, height), HIGH_DETAIL_SHORT_SIDE / min(width, height))
+    else:
+        scale = min(1.0, LOW_DETAIL_MAX_SIDE / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+# Función para preparar una imagen para OpenAI: decodifica el JPEG a escala
+# reducida (draft/DCT), corrige la orientación EXIF, la reduce al tamaño que
+# consume el modelo y la recodifica como JPEG
+def preprocess_image(data, detail=IMAGE_DETAIL, quality=JPEG_QUALITY):
+    img = Image.open(BytesIO(data))
+    size = target_size(img.width, img.height, detail)
+
+    # En JPEG, draft() hace que el decodificador reduzca 1/2, 1/4 u 1/8 en
+    # la propia DCT, sin llegar a decodificar la imagen a tamaño completo
+    img.draft("RGB", size)
+    img = ImageOps.exif_transpose(img)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    # Recalcular sobre la imagen ya reducida (y quizá girada)
+    size = target_size(img.width, img.height, detail)
+    if img.size != size:
+        img = img.resize(size, Image.LANCZOS)
+
+    buffered = BytesIO()
+    img.save(buffered, format="JPEG", quality=quality, optimize=True)
+    return buffered.getvalue()
+
+
+# Función para configurar un pool de procesos donde ejecutar el preprocesado.
+# Con processes <= 1 las imágenes se procesan en el propio hilo.
+def configure_pool(processes, wait=False):
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=wait, cancel_futures=True)
+            _pool = None
+        if processes and processes > 1:
+            _pool = ProcessPoolExecutor(max_workers=processes)
+
+
+# Función para preprocesar una imagen en el pool de procesos si está configurado
+def preprocess(data, detail=IMAGE_DETAIL, quality=JPEG_QUALITY):
+    pool = _pool
+    if pool is None:
+        return preprocess_image(data, detail, quality)
+    return pool.submit(preprocess_image, data, detail, quality).result()
+
+
+# Función para preprocesar varias imágenes, repartidas entre procesos si hay pool
+def preprocess_many(blobs, detail=IMAGE_DETAIL, quality=JPEG_QUALITY):
+    pool = _pool
+    if pool is None:
+        return [preprocess_image(data, detail, quality) for data in blobs]
+    return list(pool.map(preprocess_image, blobs, [detail] * len(blobs), [quality] * len(blobs)))
+
+
+# Función para codificar una imagen preprocesada en base64
+def encode_base64(data):
+    return base64.b64encode(data).decode("utf-8")
+
+
+atexit.register(configure_pool, 0)
@@ -0,0 +1,145 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Configuración por defecto de la caché de datos de inmuebles
+DEFAULT_CACHE_PATH = os.getenv("PROPERTY_CACHE_PATH", os.path.join(".cache", "property_cache.sqlite3"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("PROPERTY_CACHE_MAX_ENTRIES", "1000"))
+DEFAULT_TTL_SECONDS = float(os.getenv("PROPERTY_CACHE_TTL_SECONDS", str(6 * 3600)))
+DEFAULT_STALE_SECONDS = float(os.getenv("PROPERTY_CACHE_STALE_SECONDS", str(24 * 3600)))
+
+
+# Caché de respuestas de propertydetails: LRU en memoria compartida entre
+# sesiones, con persistencia opcional en SQLite (path vacío para desactivarla).
+# Una entrada es fresca durante ttl segundos; después, y durante stale
+# segundos más, se sirve la copia antigua mientras se refresca en segundo plano.
+class PropertyDetailsCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES,
+                 ttl=DEFAULT_TTL_SECONDS, stale=DEFAULT_STALE_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale = stale
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._conn = None
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            with self._lock:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS property_details (
+                        property_id TEXT PRIMARY KEY,
+                        data TEXT NOT NULL,
+                        fetched_at REAL NOT NULL
+                    )
+                    """
+                )
+                self._conn.commit()
+
+    # Devuelve los datos del inmueble, llamando a fetch() solo si no hay una copia válida
+    def get(self, property_id, fetch, force_refresh=False):
+        if not force_refresh:
+            entry = self._lookup(property_id)
+            if entry is not None:
+                data, fetched_at = entry
+                age = time.time() - fetched_at
+                if age < self.ttl:
+                    self.hits += 1
+                    return data
+                if age < self.ttl + self.stale:
+                    self.stale_hits += 1
+                    self._refresh_in_background(property_id, fetch)
+                    return data
+
+        self.misses += 1
+        data = fetch()
+        self.set(property_id, data)
+        return data
+
+    def set(self, property_id, data, fetched_at=None):
+        fetched_at = fetched_at or time.time()
+        with self._lock:
+            self._store_in_memory(property_id, data, fetched_at)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO property_details (property_id, data, fetched_at) VALUES (?, ?, ?)",
+                    (property_id, json.dumps(data, ensure_ascii=False), fetched_at)
+                )
+                self._conn.execute(
+                    "DELETE FROM property_details WHERE fetched_at < ?",
+                    (time.time() - self.ttl - self.stale,)
+                )
+                self._conn.commit()
+
+    def invalidate(self, property_id):
+        with self._lock:
+            self._entries.pop(property_id, None)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM property_details WHERE property_id = ?", (property_id,))
+                self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+        return {
+            "entradas": entries,
+            "aciertos": self.hits,
+            "aciertos_caducados": self.stale_hits,
+            "fallos": self.misses
+        }
+
+    def _lookup(self, property_id):
+        with self._lock:
+            entry = self._entries.get(property_id)
+            if entry is not None:
+                self._entries.move_to_end(property_id)
+                return entry
+
+            if self._conn is None:
+                return None
+
+            row = self._conn.execute(
+                "SELECT data, fetched_at FROM property_details WHERE property_id = ?", (property_id,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            entry = (json.loads(row[0]), row[1])
+            self._store_in_memory(property_id, *entry)
+            return entry
+
+    def _store_in_memory(self, property_id, data, fetched_at):
+        self._entries[property_id] = (data, fetched_at)
+        self._entries.move_to_end(property_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _refresh_in_background(self, property_id, fetch):
+        with self._lock:
+            if property_id in self._refreshing:
+                return
+            self._refreshing.add(property_id)
+
+        def refresh():
+            try:
+                self.set(property_id, fetch())
+            except Exception:
+                # Si falla el refresco se sigue sirviendo la copia antigua
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(property_id)
+
+        threading.Thread(target=refresh, daemon=True).start()
@@ -0,0 +1,179 @@
+import os
+import re
+import threading
+import time
+
+# Límites de partida de OpenAI (peticiones y tokens por minuto). Se ajustan
+# solos con las cabeceras x-ratelimit-* de cada respuesta.
+DEFAULT_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_RPM", "500"))
+DEFAULT_TOKENS_PER_MINUTE = float(os.getenv("OPENAI_TPM", "30000"))
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+
+# Tokens que cuesta cada imagen: 85 fijos con detail "low"; con "high",
+# 85 más 170 por cada bloque de 512 px (una foto típica de 1024x768 son 4)
+LOW_DETAIL_IMAGE_TOKENS = 85
+HIGH_DETAIL_IMAGE_TOKENS = 85 + 170 * 4
+
+
+# Función para estimar los tokens que consumirá una petición: el texto del
+# prompt (unos 4 caracteres por token), las imágenes y los tokens máximos de
+# respuesta, que OpenAI también descuenta del límite por minuto
+def estimate_tokens(prompt_chars, images=0, detail="low", max_tokens=0):
+    image_tokens = HIGH_DETAIL_IMAGE_TOKENS if detail == "high" else LOW_DETAIL_IMAGE_TOKENS
+    return int(prompt_chars / 4) + images * image_tokens + max_tokens
+
+
+# Función para convertir las duraciones de las cabeceras de OpenAI ("1s",
+# "6m0s", "20ms", "1h2m3.5s") a segundos
+def parse_duration(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    try:
+        return sum(float(amount) * units[unit] for amount, unit in parts)
+    except ValueError:
+        return None
+
+
+# Cubo de tokens que se rellena de forma continua hasta su capacidad
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def set_limit(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = min(self.level, per_minute)
+
+    def wait_time(self, amount):
+        # Una petición mayor que la capacidad se deja pasar con el cubo lleno
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) / self.rate
+
+
+# Controlador de ritmo compartido por todas las sesiones y trabajadores del
+# proceso. Combina dos cubos (peticiones y tokens por minuto) con un límite
+# de concurrencia adaptativo: sube de uno en uno con cada respuesta correcta
+# y se reduce a la mitad con cada 429 (AIMD).
+class AdaptiveRateLimiter:
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = max_concurrency
+        self.in_flight = 0
+        self.blocked_until = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self._condition = threading.Condition()
+
+    # Espera hasta que haya cupo para una petición de estimated_tokens tokens
+    def acquire(self, estimated_tokens):
+        with self._condition:
+            waited = False
+            while True:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+
+                wait = max(
+                    self.blocked_until - now,
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(estimated_tokens)
+                )
+                if wait <= 0 and self.in_flight < self.concurrency_limit:
+                    break
+
+                waited = True
+                self._condition.wait(timeout=wait if wait > 0 else None)
+
+            self.requests.level -= 1
+            self.tokens.level -= estimated_tokens
+            self.in_flight += 1
+            if waited:
+                self.throttled += 1
+
+    # Libera el cupo de una petición, corrige los tokens estimados con los
+    # reales y ajusta los límites con las cabeceras de la respuesta. La
+    # concurrencia solo crece tras una llamada correcta (succeeded).
+    def release(self, estimated_tokens, used_tokens=None, headers=None, rate_limited=False, retry_after=None,
+                succeeded=False):
+        with self._condition:
+            self.in_flight -= 1
+
+            if used_tokens is not None:
+                self.tokens.level += estimated_tokens - used_tokens
+
+            if headers is not None:
+                self._update_from_headers(headers)
+
+            if rate_limited:
+                self.rate_limited += 1
+                self.concurrency_limit = max(1, self.concurrency_limit // 2)
+                pause = retry_after if retry_after is not None else 1
+                self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+            elif succeeded and self.concurrency_limit < self.max_concurrency:
+                self.concurrency_limit += 1
+
+            self._condition.notify_all()
+
+    def _update_from_headers(self, headers):
+        now = time.monotonic()
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+
+            if limit:
+                bucket.set_limit(float(limit))
+
+            if remaining is not None:
+                remaining = float(remaining)
+                bucket.refill(now)
+                bucket.level = min(bucket.level, remaining)
+
+                # Sin cupo en el servidor: esperar a que se reinicie la ventana
+                if remaining <= 0 and reset:
+                    self.blocked_until = max(self.blocked_until, now + reset)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "peticiones_por_minuto": self.requests.capacity,
+                "tokens_por_minuto": self.tokens.capacity,
+                "concurrencia": self.concurrency_limit,
+                "en_curso": self.in_flight,
+                "esperas": self.throttled,
+                "errores_429": self.rate_limited
+            }
+
+
+_rate_limiter = None
+_lock = threading.Lock()
+
+
+# Función para obtener el controlador de ritmo compartido por todo el proceso
+def get_rate_limiter():
+    global _rate_limiter
+    with _lock:
+        if _rate_limiter is None:
+            _rate_limiter = AdaptiveRateLimiter()
+        return _rate_limiter
@@ -0,0 +1,241 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Carpeta con los ficheros Parquet de resultados y número de ficheros a partir
+# del cual se compactan en uno solo
+DEFAULT_STORE_PATH = os.getenv("RESULTS_STORE_PATH", os.path.join(".cache", "results"))
+COMPACT_AFTER_PARTS = int(os.getenv("RESULTS_STORE_COMPACT_AFTER", "32"))
+
+# Habitaciones del análisis final que se guardan como columnas
+ROOM_KEYS = ["estancias", "baños", "cocina", "pasillo"]
+
+# Esquema de la tabla de resultados: una fila por análisis de un inmueble
+SCHEMA = pa.schema(
+    [
+        ("property_id", pa.string()),
+        ("analyzed_at", pa.timestamp("ms", tz="UTC")),
+        ("duration_seconds", pa.float64()),
+        ("surface_area", pa.float64()),
+        ("rooms", pa.int16()),
+        ("bathrooms", pa.int16()),
+        ("price", pa.float64()),
+        ("address", pa.string()),
+        ("confidence", pa.string()),
+        ("cost_min_total", pa.float64()),
+        ("cost_max_total", pa.float64()),
+    ]
+    + [(f"needs_renovation_{room}", pa.bool_()) for room in ROOM_KEYS]
+    + [(f"cost_min_{room}", pa.float64()) for room in ROOM_KEYS]
+    + [(f"cost_max_{room}", pa.float64()) for room in ROOM_KEYS]
+)
+
+
+# Tipos de pandas con nulos para las columnas que no son float
+PANDAS_TYPES = {pa.bool_(): pd.BooleanDtype(), pa.int16(): pd.Int16Dtype(), pa.string(): pd.StringDtype()}
+
+
+def _to_pandas(table):
+    return table.to_pandas(types_mapper=PANDAS_TYPES.get)
+
+
+# Función para extraer a la vez los valores mínimo y máximo de una serie de
+# rangos de coste ("1.000 - 2.000 €"); lo que no se entiende queda como NaN
+def parse_cost_ranges(costs):
+    costs = pd.Series(costs, dtype="object").astype("string")
+    sides = costs.str.extract(r"^([^-]*)-([^-]*)$")
+    minimum = pd.to_numeric(sides[0].str.replace(r"\D", "", regex=True).replace("", pd.NA), errors="coerce")
+    maximum = pd.to_numeric(sides[1].str.replace(r"\D", "", regex=True).replace("", pd.NA), errors="coerce")
+    return minimum.astype("float64"), maximum.astype("float64")
+
+
+# Función para convertir los flags "si"/"no" en booleanos (nulo si no se sabe)
+def parse_renovation_flags(flags):
+    flags = pd.Series(flags, dtype="object").astype("string").str.strip().str.lower()
+    return flags.map({"si": True, "sí": True, "no": False}).astype("boolean")
+
+
+# Función para convertir resultados de analyze_property (o líneas del JSONL de
+# batch.py) en una tabla con columnas numéricas tipadas. Los resultados con
+# error se descartan.
+def results_to_frame(results):
+    results = [result for result in results if "error" not in result and "analysis" in result]
+    if not results:
+        return _to_pandas(SCHEMA.empty_table())
+
+    flat = pd.json_normalize(results, sep="/")
+    frame = pd.DataFrame(index=flat.index)
+
+    def column(name, default=None):
+        return flat[name] if name in flat else pd.Series(default, index=flat.index, dtype="object")
+
+    frame["property_id"] = column("property_id").astype("string")
+    frame["analyzed_at"] = pd.to_datetime(column("analyzed_at"), utc=True, errors="coerce")
+    frame["duration_seconds"] = pd.to_numeric(column("duration_seconds"), errors="coerce").astype("float64")
+    frame["surface_area"] = pd.to_numeric(column("surface_area"), errors="coerce").astype("float64")
+    frame["rooms"] = pd.to_numeric(column("rooms"), errors="coerce").astype("Int16")
+    frame["bathrooms"] = pd.to_numeric(column("bathrooms"), errors="coerce").astype("Int16")
+    frame["price"] = pd.to_numeric(column("price"), errors="coerce").astype("float64")
+    frame["address"] = column("address").astype("string")
+    frame["confidence"] = column("analysis/nivel_confianza").astype("string")
+    frame["cost_min_total"], frame["cost_max_total"] = parse_cost_ranges(column("analysis/estimación_costes/total"))
+
+    for room in ROOM_KEYS:
+        frame[f"needs_renovation_{room}"] = parse_renovation_flags(
+            column(f"analysis/análisis_por_habitación/{room}/necesita_reforma")
+        )
+    for room in ROOM_KEYS:
+        frame[f"cost_min_{room}"], frame[f"cost_max_{room}"] = parse_cost_ranges(
+            column(f"analysis/estimación_costes/desglose/{room}")
+        )
+
+    # Sin fecha de análisis se toma el momento en que se guarda
+    frame["analyzed_at"] = frame["analyzed_at"].fillna(pd.Timestamp.now(tz="UTC")).dt.floor("ms")
+    return frame[SCHEMA.names]
+
+
+# Función para añadir las métricas de cartera a una tabla de resultados, todo
+# con operaciones vectorizadas: coste medio de reforma, coste por m², precio
+# por m² y precio por m² una vez sumada la reforma
+def portfolio_metrics(frame):
+    frame = frame.copy()
+    surface = frame["surface_area"].where(frame["surface_area"] > 0)
+    renovation_flags = frame[[f"needs_renovation_{room}" for room in ROOM_KEYS]]
+
+    frame["cost_mid_total"] = (frame["cost_min_total"] + frame["cost_max_total"]) / 2
+    frame["cost_per_m2"] = frame["cost_mid_total"] / surface
+    frame["price_per_m2"] = frame["price"] / surface
+    frame["adjusted_price_per_m2"] = (frame["price"] + frame["cost_mid_total"]) / surface
+    frame["renovation_share"] = frame["cost_mid_total"] / frame["price"].where(frame["price"] > 0)
+    frame["rooms_to_renovate"] = renovation_flags.fillna(False).astype("int8").sum(axis=1)
+    return frame
+
+
+# Función para resumir la distribución de las métricas de cartera (número de
+# valores, media y percentiles)
+def portfolio_summary(frame, columns=("cost_mid_total", "cost_per_m2", "price_per_m2", "adjusted_price_per_m2")):
+    values = frame[list(columns)].astype("float64")
+    summary = values.quantile([0.1, 0.5, 0.9]).T
+    summary.columns = ["p10", "p50", "p90"]
+    summary.insert(0, "media", values.mean())
+    summary.insert(0, "n", values.count())
+    return summary
+
+
+# Almacén de resultados en Parquet: cada escritura añade un fichero a la
+# carpeta y, cuando hay demasiados, se compactan en uno. Al leer se conserva
+# solo el análisis más reciente de cada inmueble.
+class ResultsStore:
+    def __init__(self, path=DEFAULT_STORE_PATH, compact_after=COMPACT_AFTER_PARTS):
+        self.path = path
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def parts(self):
+        return sorted(glob.glob(os.path.join(self.path, "*.parquet")))
+
+    def _write_part(self, table):
+        name = f"{time.strftime('%Y%m%d%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(self.path, "." + name + ".tmp")
+        pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, os.path.join(self.path, name))
+
+    # Guarda uno o varios resultados de analyze_property
+    def add(self, results):
+        if isinstance(results, dict):
+            results = [results]
+        frame = results_to_frame(results)
+        if frame.empty:
+            return 0
+
+        table = pa.Table.from_pandas(frame, schema=SCHEMA, preserve_index=False)
+        with self._lock:
+            self._write_part(table)
+            if len(self.parts()) > self.compact_after:
+                self.compact()
+        return len(frame)
+
+    # Junta todos los ficheros en uno, descartando análisis repetidos
+    def compact(self):
+        parts = self.parts()
+        if len(parts) <= 1:
+            return
+        table = pa.Table.from_pandas(self._read(parts), schema=SCHEMA, preserve_index=False)
+        self._write_part(table)
+        for part in parts:
+            try:
+                os.remove(part)
+            except FileNotFoundError:
+                pass
+
+    def _read(self, parts):
+        if not parts:
+            return _to_pandas(SCHEMA.empty_table())
+        frame = _to_pandas(pa.concat_tables(pq.read_table(part, schema=SCHEMA) for part in parts))
+        frame = frame.sort_values("analyzed_at", kind="stable").drop_duplicates("property_id", keep="last")
+        return frame.reset_index(drop=True)
+
+    # Tabla con el último análisis de cada inmueble
+    def load(self):
+        return self._read(self.parts())
+
+    # IDs de los inmuebles ya analizados (lee solo esa columna)
+    def property_ids(self):
+        return {
+            property_id
+            for part in self.parts()
+            for property_id in pq.read_table(part, columns=["property_id"]).column("property_id").to_pylist()
+        }
+
+    # Marca que cambia cada vez que se escribe, útil como clave de caché
+    def version(self):
+        return tuple((os.path.basename(part), os.path.getmtime(part)) for part in self.parts())
+
+    def stats(self):
+        parts = self.parts()
+        rows = sum(pq.ParquetFile(part).metadata.num_rows for part in parts)
+        return {"ficheros": len(parts), "filas": rows}
+
+
+_results_store = None
+_lock = threading.Lock()
+
+
+# Función para obtener el almacén de resultados compartido por todo el proceso
+def get_results_store():
+    global _results_store
+    with _lock:
+        if _results_store is None:
+            _results_store = ResultsStore()
+        return _results_store
+
+
+# Importa al almacén ficheros JSONL generados por batch.py
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Importa resultados JSONL de batch.py al almacén Parquet.")
+    parser.add_argument("inputs", nargs="+", help="Ficheros JSONL de resultados")
+    parser.add_argument("--store", default=DEFAULT_STORE_PATH, help="Carpeta del almacén Parquet")
+    args = parser.parse_args(argv)
+
+    store = ResultsStore(args.store)
+    imported = 0
+    for path in args.inputs:
+        with open(path, encoding="utf-8") as f:
+            imported += store.add([json.loads(line) for line in f if line.strip()])
+    store.compact()
+    print(f"{imported} resultados importados; {store.stats()['filas']} filas en {args.store}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
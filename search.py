@@ -0,0 +1,141 @@
+import logging
+import queue
+import threading
+from collections import OrderedDict
+
+from core import IDEALISTA_API_URL
+from metrics import get_metrics
+from transport import get_http_transport
+
+logger = logging.getLogger(__name__)
+
+# Resultados por página de la búsqueda (el máximo que admite la API) y
+# páginas que se piden por adelantado mientras se analizan las anteriores
+SEARCH_PAGE_SIZE = 40
+PREFETCH_PAGES = 2
+
+# Páginas de IDs recientes que se recuerdan para descartar repetidos: un
+# inmueble se repite cuando los resultados se desplazan entre dos páginas
+# mientras se recorre la búsqueda, así que basta con una ventana corta
+SEEN_WINDOW_PAGES = 5
+
+
+# Error devuelto por la API de Idealista al buscar inmuebles
+class SearchError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(f"Error al buscar inmuebles: {status_code}")
+        self.status_code = status_code
+        self.text = text
+
+
+# Función para pedir una página de resultados del listado de Idealista
+def fetch_search_page(rapidapi_key, location_id, page, operation="sale", location_name=None,
+                      min_price=None, max_price=None, order="relevance"):
+    url = f"{IDEALISTA_API_URL}/listhomes"
+    querystring = {
+        "order": order,
+        "operation": operation,
+        "locationId": location_id,
+        "numPage": page,
+        "maxItems": SEARCH_PAGE_SIZE,
+        "location": "es",
+        "locale": "es"
+    }
+    if location_name:
+        querystring["locationName"] = location_name
+    if min_price:
+        querystring["minPrice"] = min_price
+    if max_price:
+        querystring["maxPrice"] = max_price
+    headers = {
+        "x-rapidapi-key": rapidapi_key,
+        "x-rapidapi-host": "idealista7.p.rapidapi.com"
+    }
+
+    with get_metrics().span("busqueda_pagina", location_id=location_id, page=page) as span:
+        response = get_http_transport().get(url, headers=headers, params=querystring)
+        span["status"] = response.status_code
+    if response.status_code != 200:
+        raise SearchError(response.status_code, response.text)
+    return response.json()
+
+
+# Función para recorrer una búsqueda página a página, devolviendo los
+# inmuebles (propertyCode y precio) a medida que llegan. Solo se pide la
+# página siguiente cuando se han consumido los de la anterior.
+def iter_search_results(rapidapi_key, location_id, max_pages=None, **filters):
+    page = 1
+    while max_pages is None or page <= max_pages:
+        data = fetch_search_page(rapidapi_key, location_id, page, **filters)
+        elements = data.get("elementList", [])
+        get_metrics().increment("busqueda_resultados", len(elements))
+        for element in elements:
+            yield element
+
+        total_pages = data.get("totalPages", page)
+        if not elements or page >= total_pages:
+            return
+        page += 1
+
+
+# Función para consumir un iterable desde un hilo aparte con una cola
+# acotada: el hilo se adelanta como mucho maxsize elementos y se detiene
+# mientras el consumidor no avanza. Los errores se relanzan en el consumidor.
+def prefetch(iterable, maxsize):
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+    stop = threading.Event()
+
+    # Encola sin bloquearse para siempre: devuelve False si el consumidor ya
+    # no va a leer más
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+# Función para obtener los IDs de una búsqueda como un flujo: las páginas se
+# piden por adelantado en segundo plano (como mucho prefetch_pages páginas por
+# delante) y se omiten los IDs repetidos en las últimas SEEN_WINDOW_PAGES
+# páginas y los de skip. skip lo aporta quien llama y su tamaño no está acotado.
+def iter_search_property_ids(rapidapi_key, location_id, skip=(), max_pages=None, prefetch_pages=PREFETCH_PAGES,
+                             **filters):
+    seen = OrderedDict()
+    results = iter_search_results(rapidapi_key, location_id, max_pages=max_pages, **filters)
+    for element in prefetch(results, max(1, prefetch_pages) * SEARCH_PAGE_SIZE):
+        property_id = str(element.get("propertyCode", ""))
+        if not property_id or property_id in seen:
+            continue
+        seen[property_id] = None
+        if len(seen) > SEEN_WINDOW_PAGES * SEARCH_PAGE_SIZE:
+            seen.popitem(last=False)
+
+        if property_id in skip:
+            get_metrics().increment("busqueda_omitidos")
+            continue
+        yield property_id
@@ -0,0 +1,121 @@
+import os
+from io import BytesIO
+
+from PIL import Image
+
+from phash_index import compute_phash, hamming_distance
+
+# Número máximo de fotos de cada habitación que se descargan y puntúan
+MAX_CANDIDATES_PER_ROOM = int(os.getenv("SELECTION_MAX_CANDIDATES", "8"))
+
+# Fotos a menos de esta distancia de Hamming entre sus pHash se consideran la misma
+DUPLICATE_DISTANCE = int(os.getenv("SELECTION_DUPLICATE_DISTANCE", "6"))
+
+# Peso de la diversidad de color frente a la calidad al elegir varias fotos
+DIVERSITY_WEIGHT = float(os.getenv("SELECTION_DIVERSITY_WEIGHT", "0.5"))
+
+# Lado de la versión reducida sobre la que se puntúa y varianza del laplaciano
+# a partir de la cual una foto se considera razonablemente nítida
+SCORE_SIZE = 256
+SHARPNESS_REFERENCE = 150.0
+
+# Orden en que se reparte el presupuesto de imágenes: primero las
+# habitaciones que entran en la estimación de costes
+ROOM_PRIORITY = ["Cocina", "Baño", "Estancia", "Pasillo", "Vistas", "Desconocido"]
+
+
+# Función para calcular las características de una foto sobre una versión
+# reducida: nitidez (varianza del laplaciano), exposición (píxeles quemados
+# o empastados y brillo medio), histograma de color de 64 celdas y pHash
+def image_features(data):
+    import numpy as np
+
+    img = Image.open(BytesIO(data))
+    img.draft("RGB", (SCORE_SIZE * 2, SCORE_SIZE * 2))
+    img = img.convert("RGB")
+    img.thumbnail((SCORE_SIZE, SCORE_SIZE))
+
+    rgb = np.asarray(img, dtype=np.float32)
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+    laplacian = gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:] - 4 * gray[1:-1, 1:-1]
+    sharpness = float(laplacian.var())
+
+    clipped = float(((gray < 8) | (gray > 247)).mean())
+    exposure = max(0.0, 1.0 - 2 * clipped - abs(float(gray.mean()) - 128) / 256)
+
+    levels = (rgb // 64).astype(np.int32).reshape(-1, 3)
+    histogram = np.bincount(levels[:, 0] * 16 + levels[:, 1] * 4 + levels[:, 2], minlength=64)
+    histogram = histogram / histogram.sum()
+
+    return {
+        "sharpness": sharpness,
+        "exposure": exposure,
+        "quality": 0.6 * sharpness / (sharpness + SHARPNESS_REFERENCE) + 0.4 * exposure,
+        "histogram": histogram,
+        "phash": compute_phash(data)
+    }
+
+
+def _similarity(a, b):
+    import numpy as np
+
+    # Intersección de histogramas: 1 si la distribución de color es la misma
+    return float(np.minimum(a["histogram"], b["histogram"]).sum())
+
+
+# Función para ordenar las fotos de una habitación de la más a la menos
+# informativa: se elige primero la de mejor calidad y después, en cada paso,
+# la que mejor combina calidad y diferencia de color con las ya elegidas. Las
+# casi duplicadas de una foto elegida pasan al final.
+def rank_images(candidates, diversity_weight=DIVERSITY_WEIGHT, duplicate_distance=DUPLICATE_DISTANCE):
+    remaining = [(url, features) for url, features in candidates if features is not None]
+    ranked = []
+    duplicates = []
+
+    while remaining:
+        best_index, best_score = None, None
+        for index, (url, features) in enumerate(remaining):
+            similarity = max((_similarity(features, chosen) for _, chosen in ranked), default=0.0)
+            score = features["quality"] - diversity_weight * similarity
+            if best_score is None or score > best_score:
+                best_index, best_score = index, score
+
+        url, features = remaining.pop(best_index)
+        ranked.append((url, features))
+
+        # Apartar las casi duplicadas de la foto recién elegida
+        kept = []
+        for candidate in remaining:
+            if hamming_distance(candidate[1]["phash"], features["phash"]) <= duplicate_distance:
+                duplicates.append(candidate)
+            else:
+                kept.append(candidate)
+        remaining = kept
+
+    # Las fotos que no se pudieron puntuar van detrás de todas
+    failed = [(url, features) for url, features in candidates if features is None]
+    return [url for url, _ in ranked + duplicates + failed]
+
+
+# Función para repartir un presupuesto de imágenes entre habitaciones a partir
+# de las fotos ya ordenadas: una por habitación en orden de prioridad y, si
+# sobra presupuesto, la siguiente mejor de cada una por turnos hasta per_room
+def allocate_budget(ranked_by_room, per_room, budget=None):
+    rooms = sorted(
+        ranked_by_room,
+        key=lambda room_type: ROOM_PRIORITY.index(room_type) if room_type in ROOM_PRIORITY else len(ROOM_PRIORITY)
+    )
+    selected = {room_type: [] for room_type in ranked_by_room}
+    remaining = budget if budget else sum(min(per_room, len(urls)) for urls in ranked_by_room.values())
+
+    for position in range(per_room):
+        for room_type in rooms:
+            urls = ranked_by_room[room_type]
+            if remaining <= 0:
+                return selected
+            if position < len(urls):
+                selected[room_type].append(urls[position])
+                remaining -= 1
+
+    return selected
@@ -0,0 +1,60 @@
+import threading
+
+from metrics import get_metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Agrupa las llamadas concurrentes con la misma clave: la primera ejecuta la
+# función y las que llegan mientras está en curso esperan y reciben el mismo
+# resultado (o la misma excepción). Sirve para que varias sesiones que piden
+# a la vez el mismo inmueble o la misma imagen compartan una sola llamada.
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._in_flight[key] = call
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            get_metrics().increment(f"coalescidas_{self.name}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "llamadas": self.calls,
+                "coalescidas": self.coalesced,
+                "en_curso": len(self._in_flight)
+            }
@@ -0,0 +1,60 @@
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# Tamaño y calidad de las miniaturas de la galería
+THUMBNAIL_MAX_SIDE = int(os.getenv("THUMBNAIL_MAX_SIDE", "320"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "70"))
+
+# Memoria máxima para imágenes descargadas y miniaturas
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+
+# Caché LRU en memoria de bloques de bytes, limitada por tamaño total
+class BytesLRU:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def set(self, key, data):
+        # No guardar bloques que por sí solos no caben en la caché
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+# Función para generar una miniatura JPEG conservando la relación de aspecto.
+# Con draft() el JPEG original se decodifica ya reducido.
+def make_thumbnail(data, max_side=THUMBNAIL_MAX_SIDE, quality=THUMBNAIL_QUALITY):
+    img = Image.open(BytesIO(data))
+    img.draft("RGB", (max_side, max_side))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    buffered = BytesIO()
+    img.save(buffered, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffered.getvalue()
@@ -0,0 +1,278 @@
+import email.utils
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import get_metrics
+from ratelimit import get_rate_limiter, parse_duration
+
+# Tiempos de espera (conexión, lectura) y reintentos por defecto
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "30"))
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+# Códigos de estado que se consideran transitorios y se reintentan
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+# Error lanzado cuando el circuito de un servicio está abierto
+class CircuitOpenError(Exception):
+    pass
+
+
+# Cortocircuito: tras failure_threshold fallos seguidos deja de llamar al
+# servicio durante reset_timeout segundos; después permite una llamada de
+# prueba y vuelve a cerrarse si sale bien.
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "cerrado"
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return "semiabierto"
+            return "abierto"
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_in_progress:
+                raise CircuitOpenError(f"Servicio {self.name} no disponible temporalmente")
+            self._trial_in_progress = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_progress or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+    def call(self, func, *args, is_failure=lambda e: True, **kwargs):
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+
+# Función para calcular la espera antes de un reintento: respeta Retry-After
+# si el servidor lo envía y, si no (o si no se entiende), usa backoff
+# exponencial con jitter completo
+def retry_delay(attempt, response=None):
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0), BACKOFF_MAX)
+            except ValueError:
+                pass
+            try:
+                retry_date = email.utils.parsedate_to_datetime(retry_after)
+                return min(max(retry_date.timestamp() - time.time(), 0), BACKOFF_MAX)
+            except (TypeError, ValueError, OverflowError):
+                pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+# Cliente HTTP compartido: una sesión con pool de conexiones keep-alive por
+# host, tiempos de espera explícitos, reintentos y un cortocircuito por host
+class HttpTransport:
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, pool_maxsize=POOL_MAXSIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker_for(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(host)
+            return self._breakers[host]
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        breaker = self.breaker_for(url)
+        breaker.before_call()
+
+        # Cualquier excepción cuenta como fallo, para que una llamada de prueba
+        # con el circuito semiabierto nunca lo deje bloqueado
+        try:
+            return self._request_with_retries(method, url, breaker, **kwargs)
+        except Exception:
+            breaker.record_failure()
+            raise
+
+    def _request_with_retries(self, method, url, breaker, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                get_metrics().increment("reintentos_http")
+                time.sleep(retry_delay(attempt))
+                attempt += 1
+                continue
+
+            if response.status_code not in RETRY_STATUS_CODES:
+                breaker.record_success()
+                return response
+
+            if attempt >= self.max_retries:
+                # Un 429 indica límite de cuota, no caída del servicio
+                if response.status_code == 429:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+                return response
+
+            get_metrics().increment("reintentos_http")
+            time.sleep(retry_delay(attempt, response))
+            attempt += 1
+
+
+_http_transport = None
+_openai_clients = {}
+_openai_breaker = CircuitBreaker("openai")
+_lock = threading.Lock()
+
+
+# Función para obtener el cliente HTTP compartido por todo el proceso
+def get_http_transport():
+    global _http_transport
+    with _lock:
+        if _http_transport is None:
+            _http_transport = HttpTransport()
+        return _http_transport
+
+
+# Función para obtener un cliente de OpenAI reutilizable por API key. El
+# cliente no reintenta: los reintentos los hace create_chat_completion. El SDK
+# tarda en importarse, así que se carga solo cuando se necesita el primer cliente.
+def get_openai_client(api_key):
+    import openai
+
+    with _lock:
+        if api_key not in _openai_clients:
+            _openai_clients[api_key] = openai.OpenAI(
+                api_key=api_key,
+                timeout=OPENAI_TIMEOUT,
+                # Los reintentos los hace create_chat_completion, pasando por el
+                # controlador de ritmo
+                max_retries=0
+            )
+        return _openai_clients[api_key]
+
+
+# Función para saber si un error de OpenAI indica un problema del servicio
+def is_openai_outage(error):
+    import openai
+
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+# Función para llamar a OpenAI a través del cortocircuito compartido
+def call_openai(func, *args, **kwargs):
+    return _openai_breaker.call(func, *args, is_failure=is_openai_outage, **kwargs)
+
+
+# Función para crear una respuesta de chat respetando el ritmo compartido: espera
+# cupo en el controlador, llama a OpenAI a través del cortocircuito y actualiza
+# los límites con las cabeceras x-ratelimit-* y los tokens realmente usados. Los
+# reintentos (429, errores 5xx y de conexión) se hacen aquí y no en el cliente,
+# para que cada intento vuelva a pasar por el controlador de ritmo.
+def create_chat_completion(client, estimated_tokens, max_retries=MAX_RETRIES, **kwargs):
+    import openai
+
+    metrics = get_metrics()
+    limiter = get_rate_limiter()
+    attempt = 0
+    while True:
+        with metrics.span("espera_ritmo_openai"):
+            limiter.acquire(estimated_tokens)
+
+        response = None
+        headers = None
+        error = None
+        try:
+            with metrics.span("openai", model=kwargs.get("model"), tokens_estimados=estimated_tokens) as span:
+                span["intento"] = attempt
+                raw_response = call_openai(client.chat.completions.with_raw_response.create, **kwargs)
+                headers = raw_response.headers
+                response = raw_response.parse()
+        except openai.RateLimitError as e:
+            metrics.increment("openai_errores_429")
+            headers = e.response.headers
+            error = e
+        except openai.APIError as e:
+            if not is_openai_outage(e):
+                raise
+            error = e
+        finally:
+            # Cada acquire se libera una sola vez, salga como salga la llamada
+            usage = getattr(response, "usage", None)
+            limiter.release(
+                estimated_tokens,
+                used_tokens=usage.total_tokens if usage is not None else None,
+                headers=headers,
+                rate_limited=isinstance(error, openai.RateLimitError),
+                retry_after=parse_duration(headers.get("retry-after")) if error is not None and headers else None,
+                succeeded=response is not None
+            )
+
+        if error is None:
+            if usage is not None:
+                metrics.record_openai_usage(kwargs.get("model"), usage.prompt_tokens, usage.completion_tokens)
+            return response
+
+        if attempt >= max_retries:
+            raise error
+        metrics.increment("openai_reintentos")
+        # Tras un 429 el controlador ya frena todas las llamadas; el resto de
+        # errores esperan con backoff antes de volver a pedir cupo
+        if not isinstance(error, openai.RateLimitError):
+            time.sleep(retry_delay(attempt, getattr(error, "response", None)))
+        attempt += 1
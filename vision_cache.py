@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Ruta y límites por defecto de la caché de análisis de imágenes
+DEFAULT_CACHE_PATH = os.getenv("VISION_CACHE_PATH", os.path.join(".cache", "vision_cache.sqlite3"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("VISION_CACHE_MAX_ENTRIES", "20000"))
+DEFAULT_MAX_AGE_DAYS = float(os.getenv("VISION_CACHE_MAX_AGE_DAYS", "90"))
+
+# Cada cuántas escrituras se comprueba si hay que expulsar entradas
+EVICTION_INTERVAL = 100
+
+
+# Función para calcular la clave de la caché a partir del contenido de la imagen,
+# el tipo de habitación y la versión del prompt/modelo
+def make_cache_key(image_base64, room_type, prompt_version):
+    digest = hashlib.sha256()
+    digest.update(image_base64.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(room_type.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt_version.encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Caché persistente en SQLite de los resultados del análisis de imágenes.
+# Es segura entre hilos y entre procesos (modo WAL), expulsa las entradas
+# más antiguas que max_age y, por encima de max_entries, las menos usadas.
+class VisionCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS vision_cache (
+                    key TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_vision_cache_access ON vision_cache (last_access)")
+            self._conn.commit()
+        self.evict()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result, created_at FROM vision_cache WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+
+            self._conn.execute("UPDATE vision_cache SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, result):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO vision_cache (key, result, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result, ensure_ascii=False), now, now)
+            )
+            self._conn.commit()
+            self._writes += 1
+            needs_eviction = self._writes % EVICTION_INTERVAL == 0
+
+        if needs_eviction:
+            self.evict()
+
+    def evict(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM vision_cache WHERE created_at < ?", (time.time() - self.max_age,))
+            count = self._conn.execute("SELECT COUNT(*) FROM vision_cache").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    """
+                    DELETE FROM vision_cache WHERE key IN (
+                        SELECT key FROM vision_cache ORDER BY last_access ASC LIMIT ?
+                    )
+                    """,
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM vision_cache")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM vision_cache").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entradas": entries,
+            "aciertos": self.hits,
+            "fallos": self.misses,
+            "tasa_aciertos": self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,330 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from functools import partial
+
+from dotenv import load_dotenv
+
+from core import (
+    IMAGE_BUDGET,
+    IMAGES_PER_ROOM,
+    MAX_CONCURRENT_ROOMS,
+    MAX_IMAGES_PER_REQUEST,
+    SELECT_IMAGES,
+    analyze_rooms,
+    analyze_rooms_batched,
+    build_analysis,
+    failed_rooms,
+    extract_property_id,
+    extract_property_summary,
+    get_property_details,
+    group_images_by_room,
+)
+from selection import MAX_CANDIDATES_PER_ROOM
+
+logger = logging.getLogger(__name__)
+
+# Ruta por defecto de la lista de seguimiento
+DEFAULT_WATCHLIST_PATH = os.getenv("WATCHLIST_PATH", os.path.join(".cache", "watchlist.sqlite3"))
+
+# Datos del inmueble que se comparan entre una revisión y la siguiente
+TRACKED_FIELDS = ["surface_area", "rooms", "bathrooms", "price", "address"]
+
+
+# Lista de seguimiento en SQLite: para cada inmueble guarda las fotos por
+# habitación, las características y los análisis por habitación de la última
+# revisión, para volver a analizar solo lo que haya cambiado
+class Watchlist:
+    def __init__(self, path=DEFAULT_WATCHLIST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS watchlist (
+                    property_id TEXT PRIMARY KEY,
+                    state TEXT,
+                    added_at REAL NOT NULL,
+                    checked_at REAL,
+                    analyzed_at REAL
+                )
+                """
+            )
+            self._conn.commit()
+
+    def add(self, property_id):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO watchlist (property_id, added_at) VALUES (?, ?)",
+                (property_id, time.time())
+            )
+            self._conn.commit()
+
+    def remove(self, property_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM watchlist WHERE property_id = ?", (property_id,))
+            self._conn.commit()
+
+    def property_ids(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT property_id FROM watchlist ORDER BY added_at").fetchall()
+        return [row[0] for row in rows]
+
+    # Estado guardado en la última revisión (None si aún no se ha revisado)
+    def get(self, property_id):
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM watchlist WHERE property_id = ?", (property_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def save(self, property_id, state, analyzed):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO watchlist (property_id, state, added_at, checked_at, analyzed_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (property_id) DO UPDATE SET
+                    state = excluded.state,
+                    checked_at = excluded.checked_at,
+                    analyzed_at = CASE WHEN ? THEN excluded.analyzed_at ELSE watchlist.analyzed_at END
+                """,
+                (property_id, json.dumps(state, ensure_ascii=False), now, now, now, analyzed)
+            )
+            self._conn.commit()
+
+    def entries(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT property_id, state, added_at, checked_at, analyzed_at FROM watchlist ORDER BY added_at"
+            ).fetchall()
+        entries = []
+        for property_id, state, added_at, checked_at, analyzed_at in rows:
+            state = json.loads(state) if state else {}
+            entries.append({
+                "property_id": property_id,
+                "price": state.get("summary", {}).get("price"),
+                "total": state.get("analysis", {}).get("estimación_costes", {}).get("total"),
+                "added_at": added_at,
+                "checked_at": checked_at,
+                "analyzed_at": analyzed_at
+            })
+        return entries
+
+
+# Función para saber qué fotos de una habitación pueden entrar en el
+# análisis: todas las candidatas si se eligen puntuándolas y, si no, la
+# primera o las images_per_room primeras en el modo agrupado
+def analyzed_urls(urls, batched, images_per_room, select_images=SELECT_IMAGES):
+    if select_images:
+        return [url for url in urls if url][:MAX_CANDIDATES_PER_ROOM]
+    if batched:
+        return [url for url in urls if url][:images_per_room]
+    return urls[:1]
+
+
+# Función para revisar un inmueble de la lista: vuelve a consultar sus datos,
+# los compara con la revisión anterior y analiza solo las habitaciones cuyas
+# fotos analizadas han cambiado (o cuyo análisis anterior falló). El resto de
+# análisis por habitación se reutilizan y la estimación total se recalcula,
+# incluidos los "?" del modelo y las habitaciones que dejó fuera el presupuesto.
+# El presupuesto de imágenes se aplica a las habitaciones que se reanalizan.
+def refresh_property(property_id, rapidapi_key, api_key, watchlist, max_workers=MAX_CONCURRENT_ROOMS,
+                     batched=False, images_per_room=IMAGES_PER_ROOM, max_images_per_request=MAX_IMAGES_PER_REQUEST,
+                     select_images=SELECT_IMAGES, image_budget=IMAGE_BUDGET):
+    previous = watchlist.get(property_id) or {}
+    property_data = get_property_details(property_id, rapidapi_key, force_refresh=True)
+    summary = extract_property_summary(property_data)
+    images_by_room = group_images_by_room(property_data)
+
+    previous_samples = previous.get("samples", {})
+    previous_rooms = previous.get("room_analyses", {})
+    samples = {
+        room_type: analyzed_urls(urls, batched, images_per_room, select_images)
+        for room_type, urls in images_by_room.items()
+    }
+
+    changed_rooms = {}
+    for room_type, urls in images_by_room.items():
+        previous_analysis = previous_rooms.get(room_type.lower())
+        if (
+            previous_analysis is None
+            or samples[room_type] != previous_samples.get(room_type)
+            or (urls and previous_analysis.get("análisis_fallido"))
+        ):
+            changed_rooms[room_type] = urls
+
+    if changed_rooms:
+        if batched:
+            new_analyses = analyze_rooms_batched(
+                changed_rooms,
+                api_key,
+                max_workers=max_workers,
+                images_per_room=images_per_room,
+                max_images_per_request=max_images_per_request,
+                select_images=select_images,
+                image_budget=image_budget
+            )
+        else:
+            new_analyses = analyze_rooms(
+                changed_rooms,
+                api_key,
+                max_workers=max_workers,
+                select_images=select_images,
+                image_budget=image_budget
+            )
+    else:
+        new_analyses = {}
+
+    room_analyses = {
+        room_type.lower(): new_analyses.get(room_type.lower(), previous_rooms.get(room_type.lower()))
+        for room_type in images_by_room
+    }
+    analysis = build_analysis(dict(room_analyses), summary["surface_area"])
+
+    previous_urls = {url for urls in previous.get("images_by_room", {}).values() for url in urls}
+    current_urls = {url for urls in images_by_room.values() for url in urls}
+    previous_summary = previous.get("summary", {})
+    changes = {
+        "primera_revisión": not previous,
+        "campos_cambiados": {
+            field: [previous_summary.get(field), summary[field]]
+            for field in TRACKED_FIELDS
+            if previous and previous_summary.get(field) != summary[field]
+        },
+        "imágenes_nuevas": len(current_urls - previous_urls),
+        "imágenes_eliminadas": len(previous_urls - current_urls),
+        "habitaciones_reanalizadas": list(changed_rooms),
+        "total_anterior": previous.get("analysis", {}).get("estimación_costes", {}).get("total")
+    }
+
+    watchlist.save(property_id, {
+        "summary": {field: summary[field] for field in TRACKED_FIELDS},
+        "images_by_room": images_by_room,
+        "samples": samples,
+        "room_analyses": room_analyses,
+        "analysis": analysis
+    }, analyzed=bool(changed_rooms))
+
+    result = {
+        "property_id": property_id,
+        "surface_area": summary["surface_area"],
+        "rooms": summary["rooms"],
+        "bathrooms": summary["bathrooms"],
+        "price": summary["price"],
+        "address": summary["address"],
+        "analysis": analysis,
+        "changes": changes
+    }
+
+    # Las habitaciones fallidas se vuelven a analizar en la próxima revisión;
+    # mientras tanto el resultado no se guarda como terminado
+    failed = failed_rooms(room_analyses)
+    if failed:
+        result["error"] = f"No se pudieron analizar las imágenes de: {', '.join(failed)}"
+    return result
+
+
+def main(argv=None):
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Lista de seguimiento de inmuebles: al revisarla solo se vuelven a analizar las fotos que han cambiado."
+    )
+    parser.add_argument("--watchlist", default=DEFAULT_WATCHLIST_PATH, help="Fichero SQLite de la lista")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = subparsers.add_parser("add", help="Añade inmuebles (IDs o URLs) a la lista")
+    add_parser.add_argument("properties", nargs="+")
+
+    remove_parser = subparsers.add_parser("remove", help="Quita inmuebles de la lista")
+    remove_parser.add_argument("properties", nargs="+")
+
+    subparsers.add_parser("list", help="Muestra los inmuebles de la lista y su última estimación")
+
+    refresh_parser = subparsers.add_parser("refresh", help="Revisa todos los inmuebles de la lista")
+    refresh_parser.add_argument("-o", "--output", default="-",
+                                help="Fichero JSONL donde se añaden los resultados ('-' para stdout)")
+    refresh_parser.add_argument("-c", "--concurrency", type=int, default=4, help="Inmuebles revisados en paralelo")
+    refresh_parser.add_argument("--room-concurrency", type=int, default=MAX_CONCURRENT_ROOMS)
+    refresh_parser.add_argument("--max-images-per-request", type=int, default=0,
+                                help="Agrupa hasta N imágenes por petición a OpenAI (0 = una petición por habitación)")
+    refresh_parser.add_argument("--images-per-room", type=int, default=IMAGES_PER_ROOM)
+    refresh_parser.add_argument("--image-budget", type=int, default=IMAGE_BUDGET,
+                                help="Máximo de imágenes enviadas a OpenAI por inmueble (0 = sin límite)")
+    refresh_parser.add_argument("--no-image-selection", dest="select_images", action="store_false",
+                                default=SELECT_IMAGES,
+                                help="Analizar las primeras fotos de cada habitación en vez de elegir las mejores")
+    refresh_parser.add_argument("--results-store",
+                                help="Carpeta Parquet de resultados para la vista de cartera ('' para no guardarlos)")
+    refresh_parser.add_argument("--openai-key", default=os.getenv("OPENAI_API_KEY", ""))
+    refresh_parser.add_argument("--rapidapi-key", default=os.getenv("RAPIDAPI_KEY", ""))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", stream=sys.stderr)
+    watchlist = Watchlist(args.watchlist)
+
+    if args.command in ("add", "remove"):
+        for value in args.properties:
+            property_id = extract_property_id(value)
+            if not property_id:
+                logger.warning("No se pudo extraer el ID del inmueble de: %s", value)
+            elif args.command == "add":
+                watchlist.add(property_id)
+            else:
+                watchlist.remove(property_id)
+        return 0
+
+    if args.command == "list":
+        for entry in watchlist.entries():
+            checked_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["checked_at"])) if entry["checked_at"] else "nunca"
+            print(f"{entry['property_id']}\t{entry['price'] or '-'}\t{entry['total'] or '-'}\t{checked_at}")
+        return 0
+
+    if not args.openai_key or not args.rapidapi_key:
+        parser.error("Se necesitan las claves de OpenAI y RapidAPI (OPENAI_API_KEY y RAPIDAPI_KEY)")
+
+    from batch import run_batch
+
+    results_store = None
+    if args.results_store != "":
+        from results_store import DEFAULT_STORE_PATH, ResultsStore
+        results_store = ResultsStore(args.results_store or DEFAULT_STORE_PATH)
+
+    output = sys.stdout if args.output == "-" else open(args.output, "a", encoding="utf-8")
+    try:
+        stats = run_batch(
+            watchlist.property_ids(),
+            output,
+            args.rapidapi_key,
+            args.openai_key,
+            concurrency=args.concurrency,
+            room_concurrency=args.room_concurrency,
+            images_per_room=args.images_per_room,
+            max_images_per_request=args.max_images_per_request,
+            results_store=results_store,
+            analyze=partial(refresh_property, watchlist=watchlist),
+            select_images=args.select_images,
+            image_budget=args.image_budget
+        )
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    logger.info("Revisión terminada: %d inmuebles revisados, %d con error", stats["procesados"], stats["errores"])
+    return 1 if stats["errores"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())